@@ -7,12 +7,17 @@ def analyze_results(results_file, output_dir="results"):
     with open(results_file, 'r') as f:
         content = f.read()
 
-    json_start = content.rfind('[')
-    if json_start == -1:
-        raise ValueError(f"No JSON array found in {results_file}")
+    # Results may follow log output; the array starts at the first line opening with '['
+    # (rows hold nested lists such as "timeline", so the last '[' is not the start)
+    json_start = 0
+    if not content.lstrip().startswith('['):
+        json_start = content.find('\n[') + 1
+        if json_start == 0:
+            raise ValueError(f"No JSON array found in {results_file}")
 
     data = json.loads(content[json_start:])
-    df = pd.DataFrame(data)
+    # per-second container stats stay in the JSON; the summary works on scalar columns
+    df = pd.DataFrame(data).drop(columns=["timeline", "io_timeline", "io_hist", "qd_timeline", "client_profile"], errors="ignore")
     cols = set(df.columns)
 
     # Plot QPS vs Concurrency (selalu ada)
@@ -51,14 +56,19 @@ def analyze_results(results_file, output_dir="results"):
     avg_cpu = df['cpu'].mean() if 'cpu' in cols else None
     avg_io_bandwidth = df[io_col].mean() if io_col else 0.0
 
-    # Bottleneck heuristics
+    # Bottleneck heuristics, on runs where the bench process was not the limit
+    bound = df['client_bound'].fillna(False).astype(bool) if 'client_bound' in cols else pd.Series(False, index=df.index)
+    srv = df[~bound]
     qps_decline = False
-    if 'qps' in cols and 'conc' in cols and len(df) > 1:
-        qps_decline = df['qps'].iloc[-1] < df['qps'].iloc[0] * 0.5
-    high_cpu = (avg_cpu is not None) and (avg_cpu > 80)
-    high_io  = avg_io_bandwidth > 100  # heuristik NVMe
+    if 'qps' in cols and 'conc' in cols and len(srv) > 1:
+        qps_decline = srv['qps'].iloc[-1] < srv['qps'].iloc[0] * 0.5
+    srv_cpu = srv['cpu'].mean() if 'cpu' in cols and len(srv) else None
+    high_cpu = (srv_cpu is not None) and (srv_cpu > 80)
+    high_io  = (srv[io_col].mean() if io_col and len(srv) else 0.0) > 100  # heuristik NVMe
 
-    if qps_decline and high_cpu:
+    if len(srv) == 0:
+        bottleneck = "Client-bound (bench process CPU/GIL saturated in every run; server limit not reached)"
+    elif qps_decline and high_cpu:
         bottleneck = "CPU-bound (high CPU usage + declining QPS)"
     elif qps_decline and high_io:
         bottleneck = "I/O-bound (high I/O bandwidth + declining QPS)"
@@ -68,12 +78,16 @@ def analyze_results(results_file, output_dir="results"):
         bottleneck = "I/O-bound (high I/O bandwidth)"
     else:
         bottleneck = "Well-balanced (no clear bottleneck detected)"
+    if bound.any() and len(srv):
+        bottleneck += f"; {int(bound.sum())}/{len(df)} runs client-bound and excluded"
 
     summary = {
         "max_qps": max_qps,
         "min_p99": min_p99,
         "avg_cpu": avg_cpu,
         "avg_io_bandwidth_mb_s": avg_io_bandwidth,
+        "avg_client_cpu": df['client_cpu_pct'].mean() if 'client_cpu_pct' in cols else None,
+        "client_bound_runs": int(bound.sum()),
         "bottleneck_analysis": bottleneck
     }
     with open(f"{output_dir}/summary.json", 'w') as f:
@@ -88,5 +102,7 @@ if __name__ == "__main__":
     ap.add_argument("--output", default="results", help="Output directory base")
     args = ap.parse_args()
     for results_file in args.results:
+        if results_file.endswith(".trace.json"):
+            continue  # bench.py --trace output (Perfetto), not result rows
         output_dir = f"{args.output}/{os.path.basename(results_file).replace('.json', '')}"
         analyze_results(results_file, output_dir)
@@ -0,0 +1,339 @@
+# /bench/backends.py
+"""Backend protocol + registry used by bench.py (--db <name>).
+
+A backend wraps one engine behind connect / recreate / insert / search /
+batch_search. Qdrant and Weaviate delegate to the helpers in clients.py; the
+in-process "exact" (numpy brute force) and "hnsw" (hnswlib) backends need no
+containers and give a no-network upper bound on QPS and recall.
+"""
+import threading, time, numpy as np
+from contextlib import contextmanager
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+from clients import QdrantClientHelper, WeaviateClient
+from utils import brute_force_topk, ingest_stats, pairwise_scores
+
+BACKENDS = {}
+
+def register(cls):
+    BACKENDS[cls.name] = cls
+    return cls
+
+def get_backend(name: str, **kw) -> "Backend":
+    try:
+        cls = BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Unknown backend {name!r}; available: {', '.join(sorted(BACKENDS))}") from None
+    return cls(**kw)
+
+
+class Backend:
+    """Protocol. search/batch_search return (nq, topk) int ids padded with -1.
+
+    filter_lt (optional) restricts results to points whose filter attribute
+    (insert(..., attrs=) / upsert(..., attrs=), None = no attribute) is below it; recreate(filter_index=) declares that
+    attribute (None = not stored, False = no index, True = indexed).
+    quantization is one variant from config.yaml quantization.<name> ({} = full
+    precision); its "type" must be in quantization_types.
+    """
+    name = None             # registry key / --db value
+    label = None            # log prefix
+    container = None        # docker container sampled for CPU
+    supports_async = False  # implements connect_async / search_async / close_async
+    supports_processes = True  # a fresh connect() in another process sees the same index
+    data_dir = None         # index storage relative to NVME_ROOT (for on-disk size)
+    supports_writes = True  # implements upsert / delete (mixed workload)
+    quantization_types = ()
+
+    def __init__(self, quantization=None):
+        self.quant = dict(quantization or {})
+        if self.quant.get("type") and self.quant["type"] not in self.quantization_types:
+            raise ValueError(f"{self.name}: quantization {self.quant['type']!r} not supported "
+                             f"(supported: {', '.join(self.quantization_types) or 'none'})")
+
+    def connect(self): raise NotImplementedError
+    def recreate(self, conn, dim, metric="cosine", filter_index=None): raise NotImplementedError
+    def insert(self, conn, vectors, attrs=None, **opts) -> dict: raise NotImplementedError
+    def search(self, conn, queries, topk, ef, filter_lt=None): raise NotImplementedError
+
+    def after_insert(self, conn):
+        """Post-load step before the build phase (e.g. start compression)."""
+
+    def set_ef(self, conn, ef):
+        """Apply a search-time ef before a phase; no-op where ef is sent per request."""
+
+    def upsert(self, conn, ids, vectors, attrs=None): raise NotImplementedError
+    def delete(self, conn, ids): raise NotImplementedError
+
+    def index_status(self, conn) -> dict:
+        """{"ready": bool, "points": int, "indexed": int|None}; in-process indexes are built by insert()."""
+        return {"ready": True, "points": None, "indexed": None}
+
+    def batch_search(self, conn, queries, topk, ef, batch_size, filter_lt=None):
+        return self.search(conn, queries, topk, ef, filter_lt)
+
+
+@register
+class QdrantBackend(Backend):
+    name, label, container = "qdrant", "Qdrant", "qdrant"
+    collection = "bench"
+    supports_async = True
+    data_dir = "qdrant/collections/bench"
+    quantization_types = ("scalar", "product", "binary")
+
+    def __init__(self, quantization=None):
+        super().__init__(quantization)
+        self.h = QdrantClientHelper()
+
+    def connect(self): return self.h.connect()
+
+    def recreate(self, conn, dim, metric="cosine", filter_index=None):
+        self.h.drop_recreate(conn, self.collection, dim, metric, on_disk=True,
+                             filter_index=bool(filter_index), quantization=self.quant)
+
+    def insert(self, conn, vectors, attrs=None, **opts):
+        return self.h.insert(conn, self.collection, vectors, attrs=attrs, **opts)
+
+    def search(self, conn, queries, topk, ef, filter_lt=None):
+        return self.h.search(conn, self.collection, queries, topk, ef_search=ef, filter_lt=filter_lt,
+                             quantization=self.quant)
+
+    def index_status(self, conn):
+        return self.h.index_status(conn, self.collection)
+
+    def upsert(self, conn, ids, vectors, attrs=None): self.h.upsert(conn, self.collection, ids, vectors, attrs)
+    def delete(self, conn, ids): self.h.delete(conn, self.collection, ids)
+
+    def batch_search(self, conn, queries, topk, ef, batch_size, filter_lt=None):
+        return self.h.search_batch(conn, self.collection, queries, topk, ef_search=ef, batch_size=batch_size,
+                                   filter_lt=filter_lt, quantization=self.quant)
+
+    def connect_async(self): return self.h.connect_async()
+
+    async def search_async(self, client, queries, topk, ef, filter_lt=None):
+        return await self.h.search_async(client, self.collection, queries, topk, ef_search=ef, filter_lt=filter_lt,
+                                         quantization=self.quant)
+
+    async def close_async(self, client): await client.close()
+
+
+@register
+class WeaviateBackend(Backend):
+    name, label, container = "weaviate", "Weaviate", "weaviate"
+    classname = "BenchClass"
+    supports_async = True
+    data_dir = "weaviate/benchclass"
+    quantization_types = ("pq", "bq")
+
+    def __init__(self, quantization=None):
+        super().__init__(quantization)
+        self.h = WeaviateClient()
+
+    def connect(self): return self.h.connect()
+
+    def recreate(self, conn, dim, metric="cosine", filter_index=None, ef=None):
+        self.h.drop_recreate(conn, self.classname, dim, metric, ef=ef, filter_index=filter_index,
+                             quantization=self.quant)
+
+    def insert(self, conn, vectors, attrs=None, **opts):
+        return self.h.insert(conn, self.classname, vectors, attrs=attrs, **opts)
+
+    def after_insert(self, conn):
+        if self.quant.get("type") == "pq":
+            self.h.enable_pq(conn, self.classname, **self.quant)
+
+    def index_status(self, conn):
+        st = self.h.index_status(conn, self.classname)
+        if self.quant.get("type") == "pq":
+            # PQ trains and re-encodes after enable_pq(); searchable state is "compressed"
+            st["ready"] = st["ready"] and st["compressed"]
+        return st
+
+    def upsert(self, conn, ids, vectors, attrs=None): self.h.upsert(conn, self.classname, ids, vectors, attrs)
+    def delete(self, conn, ids): self.h.delete(conn, self.classname, ids)
+
+    def set_ef(self, conn, ef):
+        # ef is class-level in Weaviate: update it on the built index
+        self.h.set_ef(conn, self.classname, ef)
+
+    def search(self, conn, queries, topk, ef, filter_lt=None):
+        return self.h.search(conn, self.classname, queries, topk, ef=ef, filter_lt=filter_lt)
+
+    def batch_search(self, conn, queries, topk, ef, batch_size, filter_lt=None):
+        return self.h.search_batch(conn, self.classname, queries, topk, ef=ef, batch_size=batch_size,
+                                   filter_lt=filter_lt)
+
+    def connect_async(self): return self.h.connect_async()
+
+    async def search_async(self, session, queries, topk, ef, filter_lt=None):
+        return await self.h.search_async(session, self.classname, queries, topk, ef=ef, filter_lt=filter_lt)
+
+    async def close_async(self, session): await session.aclose()
+
+
+@register
+class ExactBackend(Backend):
+    """numpy brute force in the bench process; recall is 1.0 by construction."""
+    name, label, container = "exact", "Exact", "bench"
+    supports_processes = False
+    supports_writes = False  # searches a read-only (memmapped) matrix
+
+    def connect(self): return {}
+
+    def recreate(self, conn, dim, metric="cosine", filter_index=None):
+        conn.clear(); conn.update(dim=dim, metric=metric.upper())
+
+    def insert(self, conn, vectors, attrs=None, **_):
+        # the dataset (memmap) is searched in place; cosine is normalized per tile by brute_force_topk
+        t0 = time.time()
+        conn.update(vectors=vectors, attrs=attrs)
+        return ingest_stats(len(vectors), vectors.shape[1], time.time() - t0)
+
+    def search(self, conn, queries, topk, ef, filter_lt=None):
+        q = np.asarray(queries, dtype=np.float32)
+        # filtered: non-matching rows are dropped per tile (a pre-filtered scan, no copy of the matches)
+        return brute_force_topk(conn["vectors"], q, topk, metric=conn["metric"], block_rows=1 << 20,
+                                n_threads=1, attrs=conn["attrs"], filter_lt=filter_lt)
+
+
+class _RWLock:
+    """Shared (searches) / exclusive (upserts) lock; a waiting writer blocks new readers."""
+    def __init__(self):
+        self._cond, self._readers, self._writer = threading.Condition(), 0, False
+
+    @contextmanager
+    def shared(self):
+        with self._cond:
+            self._cond.wait_for(lambda: not self._writer)
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                self._cond.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        with self._cond:
+            self._cond.wait_for(lambda: not self._writer)
+            self._writer = True
+            self._cond.wait_for(lambda: not self._readers)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+@register
+class HnswBackend(Backend):
+    """hnswlib index in the bench process (same M / efConstruction as the servers)."""
+    name, label, container = "hnsw", "HNSW", "bench"
+    supports_processes = False
+    spaces = {"COSINE": "cosine", "IP": "ip", "DOT": "ip", "L2": "l2"}
+
+    def connect(self):
+        if hnswlib is None:
+            raise RuntimeError("hnswlib is not installed (pip install hnswlib) - required for --db hnsw")
+        return {}
+
+    def recreate(self, conn, dim, metric="cosine", filter_index=None, m=16, ef_construction=200):
+        conn.clear()
+        conn.update(index=hnswlib.Index(space=self.spaces[metric.upper()], dim=dim), m=m,
+                    metric=metric.upper(), ef_construction=ef_construction, ef=None, rw=_RWLock(),
+                    lock=threading.Lock(), deleted=set(), version=0, scans={})
+
+    def insert(self, conn, vectors, attrs=None, batch=10000, parallel=-1, headroom=0.25, **_):
+        idx = conn["index"]
+        t0 = time.time()
+        conn["attrs"] = attrs
+        # headroom for mixed-workload upserts; growing past it resizes under the exclusive lock
+        idx.init_index(max_elements=int(len(vectors) * (1 + headroom)) + 1,
+                       ef_construction=conn["ef_construction"], M=conn["m"])
+        for s in range(0, len(vectors), batch):
+            v = np.asarray(vectors[s:s+batch], dtype=np.float32)
+            idx.add_items(v, np.arange(s, s + len(v)), num_threads=parallel)
+        return ingest_stats(len(vectors), vectors.shape[1], time.time() - t0)
+
+    def upsert(self, conn, ids, vectors, attrs=None):
+        # ids < len(conn["attrs"]) keep their insert-time attribute (the only ones updates send);
+        # new ids have none and never pass a filter
+        idx, need = conn["index"], max(ids) + 1
+        # exclusive: resize_index reallocates the graph, and a search racing add_items can
+        # enter through a new node that has no links yet and come back short of k
+        with conn["rw"].exclusive():
+            if need > idx.get_max_elements():
+                idx.resize_index(max(need, 2 * idx.get_max_elements()))
+            idx.add_items(np.asarray(vectors, dtype=np.float32), np.asarray(ids), num_threads=1)
+        with conn["lock"]:
+            conn["deleted"].difference_update(int(i) for i in ids)
+            conn["version"] += 1
+
+    def delete(self, conn, ids):
+        with conn["lock"]:
+            for i in ids:
+                conn["index"].mark_deleted(int(i))
+                conn["deleted"].add(int(i))
+            conn["version"] += 1
+
+    def search(self, conn, queries, topk, ef, filter_lt=None):
+        with conn["rw"].shared():
+            return self._search(conn, queries, int(topk), max(int(ef), int(topk)), filter_lt)
+
+    def _search(self, conn, queries, topk, ef, filter_lt):
+        idx = conn["index"]
+        q = np.asarray(queries, dtype=np.float32)
+        if filter_lt is None:
+            self._apply_ef(conn, ef)
+            labels, _ = idx.knn_query(q, k=topk, num_threads=1)
+            return labels.astype(np.int64)
+        attrs, n = conn["attrs"], len(conn["attrs"])
+        matches = conn.setdefault("matches", {})
+        if filter_lt not in matches:
+            matches[filter_lt] = np.flatnonzero(np.asarray(attrs) < filter_lt)
+        ids = matches[filter_lt]
+        # the traversal visits ~ef / selectivity nodes to collect ef matches: widen ef by that factor,
+        # and scan the matches exactly once that is no cheaper than a graph search
+        ef = min(n, max(ef, -(-ef * n // max(len(ids), 1))))
+        if len(ids) <= ef:
+            return self._scan(conn, q, topk, filter_lt)
+        self._apply_ef(conn, ef)
+        # hnswlib filters during traversal (Python callback per visited node)
+        keep = lambda label: label < n and attrs[label] < filter_lt
+        try:
+            labels, _ = idx.knn_query(q, k=min(topk, len(ids)), num_threads=1, filter=keep)
+        except RuntimeError:  # fewer than k matches reachable (deletes), even with the wider ef
+            return self._scan(conn, q, topk, filter_lt)
+        out = np.full((len(q), topk), -1, dtype=np.int64)
+        out[:, :labels.shape[1]] = labels
+        return out
+
+    @staticmethod
+    def _apply_ef(conn, ef):
+        if conn["ef"] != ef:
+            conn["index"].set_ef(ef); conn["ef"] = ef
+
+    @staticmethod
+    def _scan(conn, q, topk, filter_lt):
+        """Exact top-k over the matching ids; their live vectors are gathered once per write."""
+        with conn["lock"]:
+            version, ids, x = conn["scans"].get(filter_lt, (None, None, None))
+            if version != conn["version"]:
+                ids = conn["matches"][filter_lt]
+                if conn["deleted"]:
+                    ids = ids[~np.isin(ids, list(conn["deleted"]))]
+                x = np.asarray(conn["index"].get_items(ids), dtype=np.float32).reshape(len(ids), -1)
+                conn["scans"][filter_lt] = (conn["version"], ids, x)
+        out = np.full((len(q), topk), -1, dtype=np.int64)
+        k = min(topk, len(ids))
+        if not k:
+            return out
+        s = pairwise_scores(q, x, conn["metric"])
+        top = np.argpartition(-s, k - 1, axis=1)[:, :k]
+        order = np.take_along_axis(s, top, axis=1).argsort(axis=1)[:, ::-1]
+        out[:, :k] = ids[np.take_along_axis(top, order, axis=1)]
+        return out
@@ -1,10 +1,16 @@
 # /bench/bench.py
 #!/usr/bin/env python3
-import argparse, json, os, time, threading, numpy as np
+import argparse, json, os, time, numpy as np
 from datetime import datetime
-from clients import QdrantClientHelper, WeaviateClient
-from monitoring import IOMonitor, sample_container_cpu
-from utils import brute_force_topk, recall_at_k
+import loadgen, tracing
+from backends import BACKENDS, get_backend
+from clients import CLIENT_PHASES, FILTER_FIELD
+from monitoring import CgroupIOMonitor, ClientMonitor, ContainerStatsCollector, IOMonitor, StackSampler, cgroup_path
+from datasets import dataset_files, load_or_compute_filtered_gt, load_or_compute_gt, make_or_load_attributes
+from loadgen import (make_async_search_callable, make_mixed_callable, make_mutation_op, make_open_loop_callable,
+                     make_process_search_callable, make_search_callable)
+from metrics import quality_metrics, query_recall
+from utils import LatencyHistogram, dir_size_bytes
 
 # ---------------------------------------------------------
 # Utility
@@ -31,386 +37,523 @@ def budget_enough(budget_s, need):
 # ---------------------------------------------------------
 # Main concurrency runner
 # ---------------------------------------------------------
-def run_concurrency_grid(container_name, run_seconds, queries, search_callable, budget_s=300):
+STATS = None
+
+def stats_collector(*containers):
+    """Process-wide streaming stats collector; watches the DB and the bench container."""
+    global STATS
+    if STATS is None:
+        STATS = ContainerStatsCollector()
+    for c in containers:
+        STATS.watch(c)
+    return STATS
+
+
+def measure_run(container_name, run_seconds, run):
+    """Execute run() under CPU + I/O monitoring; return the metrics part of a result row.
+
+    row["timeline"] holds the per-second container stats (CPU, memory, network,
+    block I/O) of container_name and the bench container during the run;
+    cg_* columns and row["io_timeline"] are container_name's own device I/O
+    and page faults from its cgroup (read_mb / write_mb are host-wide). With
+    bpftrace, dev_* columns, row["io_hist"] (request size / device latency
+    buckets) and row["qd_timeline"] (requests in flight) describe the device
+    side, restricted to container_name's cgroup if io_trace.cgroup_filter.
+    client_* columns describe the bench process (see client_side()).
+
+    run() returns qps, (qps, latencies) or (qps, latencies, extra); latencies is
+    a LatencyHistogram or a list of seconds, extra a dict merged into the row
+    (load-phase quality, generator stats, ...).
+    """
+    # I/O monitoring
+    trace = CONF.get("io_trace", {})
+    io_t0 = time.time()
+    io_monitor = IOMonitor(cgroup_path(container_name) if trace.get("cgroup_filter", True) else None,
+                           trace.get("qd_interval_ms", 100))
+    io_thread = io_monitor.start_monitoring(run_seconds)
+
+    # Container stats (streaming; already running from earlier runs)
+    stats = stats_collector(container_name, "bench")
+    cg_io = CgroupIOMonitor(container_name, CONF.get("cgroup_io_interval_s", 1.0)).start()
+    tracing.instant("monitors started", container=container_name)
+    prof = CONF.get("client_profile", {})
+    loadgen.PROFILER = StackSampler(prof.get("interval_ms", 5) / 1000).start() if prof.get("enabled") else None
+    CLIENT_PHASES.reset()
+    client = ClientMonitor().start()
+
+    # Run benchmark with latency tracking
+    t0 = time.time()
+    with tracing.span("load", container=container_name):
+        result = run()
+    extra = {}
+    if isinstance(result, tuple) and len(result) == 3:
+        qps, latencies, extra = result
+    elif isinstance(result, tuple) and len(result) == 2:
+        qps, latencies = result
+    else:
+        qps = result
+        latencies = []
+    elapsed = time.time() - t0
+
+    # Stop monitors
+    client.stop()
+    if loadgen.PROFILER:
+        loadgen.PROFILER.stop()
+    cg_io.stop()
+    io_monitor.stop_monitoring()
+    io_thread.join(timeout=1)
+    tracing.instant("monitors stopped", container=container_name)
+
+    timeline = stats.since(t0)
+    cpu_values = [s["cpu_pct"] for s in timeline if s["container"] in (container_name, "host")]
+    cpu_mean = float(np.mean(cpu_values)) if cpu_values else 0.0
+    # resident set at the end of the load phase (includes pages the searches faulted in)
+    last = stats.latest(container_name)
+    memory = {k: last[k] for k in ("mem_resident_mb", "mem_cache_mb") if k in last}
+    io_stats = io_monitor.parse_bandwidth()
+    io_hists = io_monitor.parse_histograms()
+    dev_stats = {k: v for k, v in io_hists.items() if k.startswith("dev_")}
+    tracing.timeline("stats", timeline, t0, group="container")
+    tracing.timeline(f"cgroup io {container_name}", cg_io.timeline(), cg_io.samples[0][0] if cg_io.samples else t0)
+    # QD samples count from bpftrace attach, shortly after io_t0
+    tracing.timeline("device queue depth", io_hists.get("qd_timeline"), io_t0)
+    io_bw    = float(io_stats.get('avg_bandwidth_mb_s', 0.0))
+    read_mb  = float(io_stats.get('read_mb', 0.0))
+    write_mb = float(io_stats.get('write_mb', 0.0))
+
+    # Calculate latency percentiles (per-request histogram; plain lists still accepted)
+    if isinstance(latencies, LatencyHistogram):
+        latency_stats = latencies.summary()
+    elif latencies is not None and len(latencies) > 0:
+        latency_stats = {
+            "min_latency_ms": float(np.min(latencies)) * 1000,
+            "mean_latency_ms": float(np.mean(latencies)) * 1000,
+            "p50_latency_ms": float(np.percentile(latencies, 50)) * 1000,
+            "p95_latency_ms": float(np.percentile(latencies, 95)) * 1000,
+            "p99_latency_ms": float(np.percentile(latencies, 99)) * 1000,
+            "p999_latency_ms": float(np.percentile(latencies, 99.9)) * 1000,
+            "max_latency_ms": float(np.max(latencies)) * 1000,
+        }
+    else:
+        latency_stats = LatencyHistogram().summary()
+    client_stats = client_side(container_name, client, qps * run_seconds, extra.get("processes", 1))
+    profile = loadgen.PROFILER.top(prof.get("top", 20)) if loadgen.PROFILER else None
+    loadgen.PROFILER = None
+
+    return {
+        "qps": qps,
+        "cpu": cpu_mean,
+        "avg_bandwidth_mb_s": io_bw,
+        "read_mb": read_mb,
+        "write_mb": write_mb,
+        "elapsed": elapsed,
+        **memory,
+        **latency_stats,
+        **cg_io.summary(int(round(qps * run_seconds))),
+        **dev_stats,
+        **client_stats,
+        **extra,
+        "timeline": timeline,
+        "io_timeline": cg_io.timeline(),
+        "io_hist": io_hists.get("io_hist"),
+        "qd_timeline": io_hists.get("qd_timeline"),
+        "client_profile": profile,
+    }
+
+
+def client_side(container_name, client, queries, processes=1):
+    """Bench-process CPU / GIL wait, client time per query by phase, and the client_bound flag.
+
+    A run is client-bound when the bench process used client_saturation.cpu_pct
+    of the cores it can use (one per process: Python threads share a GIL) or
+    its threads waited on average client_saturation.gil_wait_ms for the GIL;
+    QPS is then a lower bound for the server. None for in-process backends.
+    """
+    sat = CONF.get("client_saturation", {})
+    out = client.summary()
+    phases = CLIENT_PHASES.totals()
+    busy = sum(phases.values())
+    for k, v in phases.items():
+        out[f"client_{k}_ms_per_query"] = v * 1000 / max(queries, 1)
+        out[f"client_{k}_share"] = v / busy if busy else 0.0
+    bound = (out["client_cpu_pct"] >= sat.get("cpu_pct", 90) * processes
+             or out["client_gil_wait_ms_mean"] >= sat.get("gil_wait_ms", 2.0))
+    out["client_bound"] = bool(bound) if container_name != "bench" else None
+    if out["client_bound"]:
+        log(f"[{container_name}] Client-bound run: bench CPU {out['client_cpu_pct']:.0f}%, "
+            f"GIL wait {out['client_gil_wait_ms_mean']:.1f} ms - server numbers are a lower bound")
+    return out
+
+
+def run_concurrency_grid(container_name, run_seconds, queries, search_callable, budget_s=300, batch_sizes=None,
+                         conc_grid=None, engine="thread"):
+    """Closed loop: run search_callable over concurrency x query_batch_size x repeats.
+
+    batch_sizes defaults to [1] (one request per query); values > 1 make the
+    callable use the backend's batched search. conc_grid defaults to
+    CONF["concurrency_grid"]; engine is recorded in each row.
+    """
     results = []
-    total_conc = len(CONF["concurrency_grid"])
-    total_runs = total_conc * CONF.get("repeats", 1)
+    batch_sizes = list(batch_sizes or [1])
+    grid = [(conc, bs) for conc in (conc_grid or CONF["concurrency_grid"]) for bs in batch_sizes]
+    repeats = CONF.get("repeats", 1)
+    total_runs = len(grid) * repeats
     run_count = 0
 
-    for conc in CONF["concurrency_grid"]:
-        if not budget_enough(budget_s, run_seconds + 2):
-            break
-        for repeat in range(CONF.get("repeats", 1)):
+    for i, (conc, bs) in enumerate(grid):
+        for repeat in range(repeats):
             if not budget_enough(budget_s, run_seconds + 2):
-                break
+                # say what the budget cut, so a short grid is not mistaken for the full one
+                skipped = [f"({c}, {b})" for c, b in grid[i:]]
+                if repeat:
+                    skipped[0] += f" from repeat {repeat+1}"
+                log(f"[{container_name}] Budget exhausted after {run_count}/{total_runs} runs; "
+                    f"skipped (conc, batch): {', '.join(skipped)}")
+                return results
 
             run_count += 1
-            log(f"[{container_name}] Concurrency {conc}, repeat {repeat+1}/{CONF.get('repeats', 1)}")
-
-            # Warm-up
-            try:
-                warmup_result = search_callable(queries[:min(64, len(queries))], 1, conc)
-                _ = warmup_result[0] if isinstance(warmup_result, tuple) else warmup_result
-                time.sleep(0.3)
-            except Exception as e:
-                log(f"[{container_name}] Warm-up failed: {e}")
-
-            # I/O monitoring
-            io_monitor = IOMonitor()
-            io_thread = io_monitor.start_monitoring(run_seconds)
-
-            # CPU monitoring
-            cpu_values = []
-            cpu_monitoring = True
-            def cpu_thread_fn():
-                while cpu_monitoring:
-                    cpu_pct = sample_container_cpu(container_name, 1)
-                    if cpu_pct > 0:
-                        cpu_values.append(cpu_pct)
-                    time.sleep(0.2)
-            cpu_thread = threading.Thread(target=cpu_thread_fn, daemon=True)
-            cpu_thread.start()
-
-            # Run benchmark with latency tracking
-            t0 = time.time()
-            result = search_callable(queries, run_seconds, conc)
-            if isinstance(result, tuple) and len(result) == 2:
-                qps, latencies = result
-            else:
-                qps = result
-                latencies = []
-            elapsed = time.time() - t0
-
-            # Stop monitors
-            cpu_monitoring = False
-            io_monitor.stop_monitoring()
-            io_thread.join(timeout=1)
-            cpu_thread.join(timeout=1)
-
-            cpu_mean = float(np.mean(cpu_values)) if cpu_values else 0.0
-            io_stats = io_monitor.parse_bandwidth()
-            io_bw    = float(io_stats.get('avg_bandwidth_mb_s', 0.0))
-            read_mb  = float(io_stats.get('read_mb', 0.0))
-            write_mb = float(io_stats.get('write_mb', 0.0))
-
-            # Calculate latency percentiles
-            latency_stats = {}
-            if latencies and len(latencies) > 0:
-                latency_stats = {
-                    "min_latency_ms": float(np.min(latencies)) * 1000,
-                    "mean_latency_ms": float(np.mean(latencies)) * 1000,
-                    "p50_latency_ms": float(np.percentile(latencies, 50)) * 1000,
-                    "p95_latency_ms": float(np.percentile(latencies, 95)) * 1000,
-                    "p99_latency_ms": float(np.percentile(latencies, 99)) * 1000,
-                    "max_latency_ms": float(np.max(latencies)) * 1000,
-                }
-            else:
-                latency_stats = {
-                    "min_latency_ms": None,
-                    "mean_latency_ms": None,
-                    "p50_latency_ms": None,
-                    "p95_latency_ms": None,
-                    "p99_latency_ms": None,
-                    "max_latency_ms": None,
-                }
-
-            results.append({
-                "conc": conc,
-                "qps": qps,
-                "cpu": cpu_mean,
-                "avg_bandwidth_mb_s": io_bw,
-                "read_mb": read_mb,
-                "write_mb": write_mb,
-                "elapsed": elapsed,
-                **latency_stats
-            })
+            log(f"[{container_name}] Concurrency {conc}, batch {bs}, repeat {repeat+1}/{repeats}")
+
+            with tracing.span(f"conc={conc} batch={bs}", repeat=repeat + 1, engine=engine):
+                # Warm-up
+                try:
+                    with tracing.span("warm-up"):
+                        warmup_result = search_callable(queries[:min(64, len(queries))], 1, conc, bs)
+                    _ = warmup_result[0] if isinstance(warmup_result, tuple) else warmup_result
+                    time.sleep(0.3)
+                except Exception as e:
+                    log(f"[{container_name}] Warm-up failed: {e}")
+
+                row = measure_run(container_name, run_seconds, lambda: search_callable(queries, run_seconds, conc, bs))
+            results.append({"conc": conc, "query_batch_size": bs, "engine": engine, **row})
     return results
 
 
-# ---------------------------------------------------------
-# Database runners
-# ---------------------------------------------------------
-def run_qdrant(ds, vec_override=None, qry_override=None):
-    qc = QdrantClientHelper()
-    conn = qc.connect()
-
-    # Load dataset
-    from datasets import make_or_load_dataset
-    vectors, queries = make_or_load_dataset(
-        root=CONF.get("data_root", "../datasets"),
-        name=ds["name"],
-        n=ds["n_vectors"],
-        dim=ds["dim"],
-        n_queries=ds["n_queries"],
-        seed=CONF.get("seed", 42),
-    )
-    if vec_override is not None and qry_override is not None:
-        vectors, queries = vec_override, qry_override
-
-    qc.drop_recreate(conn, "bench", ds["dim"], "Cosine", on_disk=True)
-    qc.insert(conn, "bench", vectors)
-
-    # Ground-truth for recall
-    gt_q  = int(CONF.get("gt_queries_for_recall", 128))
-    gt_idx = brute_force_topk(vectors, queries[:gt_q], CONF["topk"], metric="COSINE")
+def run_offered_load_grid(container_name, run_seconds, queries, open_loop_callable, budget_s=300):
+    """Open loop: sweep open_loop.offered_qps_grid (target arrival rates) x repeats."""
+    results = []
+    ol = CONF.get("open_loop", {})
+    for rate in ol.get("offered_qps_grid", [100]):
+        if not budget_enough(budget_s, run_seconds + 3):
+            break
+        for repeat in range(CONF.get("repeats", 1)):
+            if not budget_enough(budget_s, run_seconds + 3):
+                break
+            log(f"[{container_name}] Offered load {rate} qps ({ol.get('arrival', 'poisson')}), "
+                f"repeat {repeat+1}/{CONF.get('repeats', 1)}")
+
+            with tracing.span(f"offered {rate} qps", repeat=repeat + 1):
+                # Warm-up at the target rate
+                try:
+                    with tracing.span("warm-up"):
+                        open_loop_callable(queries[:min(64, len(queries))], 1, rate)
+                    time.sleep(0.3)
+                except Exception as e:
+                    log(f"[{container_name}] Warm-up failed: {e}")
+
+                row = measure_run(container_name, run_seconds,
+                                  lambda: open_loop_callable(queries, run_seconds, rate, repeat))
+            results.append({"offered_qps": rate, "arrival": ol.get("arrival", "poisson"), **row})
+    return results
 
-    # Sensitivity study: test different ef values
-    if ARGS.sensitivity:
-        ef_values = [64, 128, 192, 256]
-        all_results = []
 
-        for ef in ef_values:
-            log(f"[Qdrant] Testing ef_search={ef}")
-
-            # Callable with latency tracking
-            def search_callable(qs, secs, conc):
-                from concurrent.futures import ThreadPoolExecutor, as_completed
-                stop_at = time.time() + secs
-                chunks = np.array_split(qs, conc)
-                all_latencies = []
-
-                def worker(batch):
-                    done = 0
-                    worker_latencies = []
-                    while time.time() < stop_at:
-                        t_start = time.time()
-                        _ = qc.search(conn, "bench", batch, CONF["topk"], ef_search=ef)
-                        t_end = time.time()
-                        worker_latencies.append(t_end - t_start)
-                        done += len(batch)
-                    return done, worker_latencies
-
-                total = 0
-                with ThreadPoolExecutor(max_workers=conc) as ex:
-                    futs = [ex.submit(worker, b) for b in chunks if len(b) > 0]
-                    for fu in as_completed(futs):
-                        worker_total, worker_latencies = fu.result()
-                        total += worker_total
-                        all_latencies.extend(worker_latencies)
-
-                return total / float(secs), all_latencies
-
-            results = run_concurrency_grid("qdrant", CONF["run_seconds"], queries, search_callable, budget_s=ARGS.budget_s)
-
-            # Calculate recall for this ef
-            res_idx = qc.search(conn, "bench", queries[:min(64, gt_q)], CONF["topk"], ef_search=ef)
-            recall = recall_at_k(gt_idx[:min(64, gt_q)], res_idx)
-            log(f"[Qdrant] ef={ef}, recall@{CONF['topk']}={recall:.3f}")
-
-            # Add ef and recall to results
-            for r in results:
-                r["ef"] = ef
-                r["recall"] = recall
+def process_opts():
+    pe = CONF.get("process_engine", {})
+    return {"processes": pe.get("processes") or os.cpu_count() or 1}
 
-            all_results.extend(results)
 
-        return all_results
-    else:
-        # Normal benchmark with fixed ef and latency tracking
-        def search_callable(qs, secs, conc):
-            from concurrent.futures import ThreadPoolExecutor, as_completed
-            stop_at = time.time() + secs
-            chunks = np.array_split(qs, conc)
-            all_latencies = []
-
-            def worker(batch):
-                done = 0
-                worker_latencies = []
-                while time.time() < stop_at:
-                    t_start = time.time()
-                    _ = qc.search(conn, "bench", batch, CONF["topk"], ef_search=64)
-                    t_end = time.time()
-                    worker_latencies.append(t_end - t_start)
-                    done += len(batch)
-                return done, worker_latencies
-
-            total = 0
-            with ThreadPoolExecutor(max_workers=conc) as ex:
-                futs = [ex.submit(worker, b) for b in chunks if len(b) > 0]
-                for fu in as_completed(futs):
-                    worker_total, worker_latencies = fu.result()
-                    total += worker_total
-                    all_latencies.extend(worker_latencies)
-
-            return total / float(secs), all_latencies
-
-        results = run_concurrency_grid("qdrant", CONF["run_seconds"], queries, search_callable, budget_s=ARGS.budget_s)
-
-        # Recall@k (subset 64)
-        res_idx = qc.search(conn, "bench", queries[:min(64, gt_q)], CONF["topk"], ef_search=64)
-        recall = recall_at_k(gt_idx[:min(64, gt_q)], res_idx)
-        log(f"[Qdrant] recall@{CONF['topk']}={recall:.3f}")
-
-        # Add recall to results
-        for r in results:
-            r["recall"] = recall
+def mixed_opts():
+    mw = CONF.get("mixed_workload", {})
+    return {"read_write_ratio": float(mw.get("read_write_ratio", 10)), "writers": int(mw.get("writers", 1))}
 
-        return results
 
+def open_loop_opts():
+    ol = CONF.get("open_loop", {})
+    return {"arrival": ol.get("arrival", "poisson"), "max_inflight": ol.get("max_inflight", 256),
+            "seed": CONF.get("seed", 42)}
 
-def run_weaviate(ds, vec_override=None, qry_override=None):
-    wh = WeaviateClient()
-    conn = wh.connect()
 
-    # Load dataset
-    from datasets import make_or_load_dataset
-    vectors, queries = make_or_load_dataset(
-        root=CONF.get("data_root", "../datasets"),
-        name=ds["name"],
-        n=ds["n_vectors"],
-        dim=ds["dim"],
-        n_queries=ds["n_queries"],
-        seed=CONF.get("seed", 42),
-    )
-    if vec_override is not None and qry_override is not None:
-        vectors, queries = vec_override, qry_override
+# ---------------------------------------------------------
+# Quality
+# ---------------------------------------------------------
+def quality_check(name, search, gt_idx, queries, extra=""):
+    """Post-run recall/MRR/nDCG over every ground-truth query."""
+    with tracing.span("recall check", queries=len(gt_idx)):
+        quality = quality_metrics(gt_idx, search(queries[:len(gt_idx)]))
+    k = CONF["topk"]
+    log(f"[{name}] {extra}recall@{k}={quality[f'recall@{k}']:.3f}, "
+        f"p05={quality[f'recall@{k}_p05']:.2f}, mrr={quality['mrr']:.3f}, ndcg@{k}={quality[f'ndcg@{k}']:.3f}")
+    # "recall" stays the headline column used by analyze_results.py
+    return {"recall": quality[f"recall@{k}"], **quality}
 
-    wh.drop_recreate(conn, "BenchClass", ds["dim"], "cosine")
-    wh.insert(conn, "BenchClass", vectors)
-    time.sleep(1)
 
-    gt_q  = int(CONF.get("gt_queries_for_recall", 128))
-    gt_idx = brute_force_topk(vectors, queries[:gt_q], CONF["topk"], metric="COSINE")
+# ---------------------------------------------------------
+# Build phase
+# ---------------------------------------------------------
+def build_phase(b, conn, n, ingest, probe, gt_probe, ef):
+    """Poll the engine after ingest until the index is built and searchable.
+
+    Every poll reads b.index_status() and runs the probe queries; the recall of
+    the first probe after the engine reports ready is taken as full recall.
+    time_to_searchable_s counts from ingest start until the engine reports the
+    index ready (Qdrant: green with an idle optimizer; Weaviate: shards READY
+    with empty queues). time_to_first_results_s is the first probe within
+    recall_tolerance of full recall; it can come much earlier because engines
+    scan unindexed segments exactly, so it measures query availability, not
+    the index.
+    """
+    bc = CONF.get("build_phase", {})
+    timeout_s, poll_s = bc.get("timeout_s", 1800), bc.get("poll_s", 0.5)
+    k = CONF["topk"]
+    t0 = time.time()
+    probes, t_ready, status = [], None, {}
+    while True:
+        status = b.index_status(conn)
+        ready = status.get("ready") and (status.get("points") is None or status["points"] >= n)
+        t = time.time() - t0
+        rec = float(query_recall(gt_probe, b.search(conn, probe, k, ef), k).mean())
+        probes.append((t, rec))
+        tracing.counter("build progress", recall=rec, points=status.get("points"), indexed=status.get("indexed"))
+        if ready:
+            t_ready = t
+            break
+        if t > timeout_s:
+            log(f"[{b.label}] index not ready after {timeout_s}s: {status}")
+            break
+        time.sleep(poll_s)
+
+    full = probes[-1][1]
+    t_search = next(t for t, r in probes if r >= full - bc.get("recall_tolerance", 0.01))
+    nvme = os.environ.get("NVME_ROOT", CONF.get("nvme_root", "/nvme"))
+    disk = dir_size_bytes(os.path.join(nvme, b.data_dir)) if b.data_dir else 0
+    out = {
+        "index_ready": t_ready is not None,
+        "index_build_seconds": t_ready if t_ready is not None else float("nan"),
+        "time_to_searchable_s": ingest["ingest_seconds"] + (t_ready if t_ready is not None else float("nan")),
+        "time_to_first_results_s": ingest["ingest_seconds"] + t_search,
+        "searchable_recall": full,
+        "indexed_vectors": status.get("indexed"),
+        "index_disk_mb": disk / 1e6,
+    }
+    log(f"[{b.label}] Index built {out['index_build_seconds']:.1f}s after ingest; searchable at "
+        f"{out['time_to_searchable_s']:.1f}s (recall@{k}={full:.3f}), full-recall results from "
+        f"{out['time_to_first_results_s']:.1f}s; on disk {out['index_disk_mb']:.0f} MB")
+    return out
 
-    # Sensitivity study: test different ef values
-    if ARGS.sensitivity:
-        ef_values = [64, 128, 192, 256]
-        all_results = []
 
-        for ef in ef_values:
-            log(f"[Weaviate] Testing ef={ef}")
-
-            # Weaviate needs to recreate collection with new ef value
-            wh.drop_recreate(conn, "BenchClass", ds["dim"], "cosine", ef=ef)
-            wh.insert(conn, "BenchClass", vectors)
-            time.sleep(1)
-
-            def search_callable(qs, secs, conc):
-                from concurrent.futures import ThreadPoolExecutor, as_completed
-                stop_at = time.time() + secs
-                chunks = np.array_split(qs, conc)
-                all_latencies = []
-
-                def worker(batch):
-                    done = 0
-                    worker_latencies = []
-                    while time.time() < stop_at:
-                        t_start = time.time()
-                        _ = wh.search(conn, "BenchClass", batch, CONF["topk"], ef=ef)
-                        t_end = time.time()
-                        worker_latencies.append(t_end - t_start)
-                        done += len(batch)
-                    return done, worker_latencies
-
-                total = 0
-                with ThreadPoolExecutor(max_workers=conc) as ex:
-                    futs = [ex.submit(worker, b) for b in chunks if len(b) > 0]
-                    for fu in as_completed(futs):
-                        worker_total, worker_latencies = fu.result()
-                        total += worker_total
-                        all_latencies.extend(worker_latencies)
-
-                return total / float(secs), all_latencies
-
-            results = run_concurrency_grid("weaviate", CONF["run_seconds"], queries, search_callable, budget_s=ARGS.budget_s)
-
-            # Calculate recall for this ef
-            res_idx = wh.search(conn, "BenchClass", queries[:min(64, gt_q)], CONF["topk"], ef=ef)
-            recall = recall_at_k(gt_idx[:min(64, gt_q)], res_idx)
-            log(f"[Weaviate] ef={ef}, recall@{CONF['topk']}={recall:.3f}")
-
-            # Add ef and recall to results
-            for r in results:
-                r["ef"] = ef
-                r["recall"] = recall
+# ---------------------------------------------------------
+# Database runners
+# ---------------------------------------------------------
+def run_backend(b, ds, vectors, queries, neighbors=None, metric="cosine"):
+    """Ingest + search phases for one backend (backends.py).
 
-            all_results.extend(results)
+    vectors/queries: the dataset loaded once in __main__ (memmaps, shared by all stages);
+    neighbors: ground truth shipped with the dataset (None = compute it).
+    """
+    conn = b.connect()
+    root, files = CONF.get("data_root", "../datasets"), dataset_files(CONF.get("data_root", "../datasets"), ds)
 
-        return all_results
+    # Ground-truth for recall (cached on disk per dataset fingerprint); needed by the build probe
+    gt_q  = int(CONF.get("gt_queries_for_recall", 128))
+    if neighbors is not None and neighbors.shape[1] >= CONF["topk"]:
+        gt_idx = neighbors[:min(gt_q, len(queries)), :CONF["topk"]]
+        log(f"[{b.label}] Using the dataset's ground-truth neighbors ({len(gt_idx)} queries)")
     else:
-        # Normal benchmark with latency tracking
-        def search_callable(qs, secs, conc):
-            from concurrent.futures import ThreadPoolExecutor, as_completed
-            stop_at = time.time() + secs
-            chunks = np.array_split(qs, conc)
-            all_latencies = []
-
-            def worker(batch):
-                done = 0
-                worker_latencies = []
-                while time.time() < stop_at:
-                    t_start = time.time()
-                    _ = wh.search(conn, "BenchClass", batch, CONF["topk"], ef=64)
-                    t_end = time.time()
-                    worker_latencies.append(t_end - t_start)
-                    done += len(batch)
-                return done, worker_latencies
-
-            total = 0
-            with ThreadPoolExecutor(max_workers=conc) as ex:
-                futs = [ex.submit(worker, b) for b in chunks if len(b) > 0]
-                for fu in as_completed(futs):
-                    worker_total, worker_latencies = fu.result()
-                    total += worker_total
-                    all_latencies.extend(worker_latencies)
-
-            return total / float(secs), all_latencies
-
-        results = run_concurrency_grid("weaviate", CONF["run_seconds"], queries, search_callable, budget_s=ARGS.budget_s)
-
-        res_idx = wh.search(conn, "BenchClass", queries[:min(64, gt_q)], CONF["topk"], ef=64)
-        recall = recall_at_k(gt_idx[:min(64, gt_q)], res_idx)
-        log(f"[Weaviate] recall@{CONF['topk']}={recall:.3f}")
-
-        # Add recall to results
-        for r in results:
-            r["recall"] = recall
+        with tracing.span("ground truth"):
+            gt_idx = load_or_compute_gt(root, ds["name"], vectors, queries[:gt_q], CONF["topk"], metric.upper(), files)
+
+    # Filtered search: attribute per vector + exact filtered GT per selectivity (threshold on the attribute)
+    attrs, filtered = None, []
+    if ARGS.filtered:
+        fc = CONF.get("filtered_search", {})
+        attrs = make_or_load_attributes(root, ds["name"], len(vectors), seed=CONF.get("seed", 42))
+        for sel in fc.get("selectivity_grid", [0.001, 0.01, 0.1, 0.5]):
+            lt = max(1, int(round(sel * len(vectors))))
+            filtered.append((sel, lt, load_or_compute_filtered_gt(root, ds["name"], vectors, queries[:gt_q],
+                                                                  CONF["topk"], metric.upper(), attrs, lt, files)))
+
+    b.recreate(conn, vectors.shape[1], metric,
+               filter_index=bool(CONF.get("filtered_search", {}).get("payload_index", True)) if ARGS.filtered else None)
+    ing = CONF.get("ingest", {}).get(b.name, {})
+    with tracing.span("ingest", vectors=len(vectors)):
+        ingest = b.insert(conn, vectors, attrs=attrs, **ing)
+        b.after_insert(conn)
+    log(f"[{b.label}] Ingested {ingest['ingest_vectors']} vectors in {ingest['ingest_seconds']:.1f}s "
+        f"({ingest['ingest_vectors_per_s']:.0f} vec/s, {ingest['ingest_mb_per_s']:.1f} MB/s)")
+    n_probe = int(CONF.get("build_phase", {}).get("probe_queries", 100))
+    with tracing.span("index build"):
+        ingest.update(build_phase(b, conn, len(vectors), ingest, queries[:min(n_probe, len(gt_idx))],
+                                  gt_idx[:n_probe], CONF.get("ef", 64)))
+
+    if ARGS.mixed:
+        mw = CONF.get("mixed_workload", {})
+        # one stream for the whole run: ids inserted / deleted at one ef stay that way for the next
+        protected = np.concatenate([np.ravel(gt_idx)] + [np.ravel(g) for _, _, g in filtered])
+        guard = [(queries, gt_idx, None)] + [(queries, g, lt) for _, lt, g in filtered]
+        write = make_mutation_op(lambda ids, rows, a: b.upsert(conn, ids, rows, a), lambda ids: b.delete(conn, ids),
+                                 vectors, protected, mix=mw.get("mix"), write_batch=int(mw.get("write_batch", 1)),
+                                 seed=CONF.get("seed", 42), attrs=attrs, guard=guard, metric=metric.upper(),
+                                 margin=float(mw.get("gt_margin", 0.01)))
+
+    def run_ef(ef):
+        if not filtered:
+            with tracing.span(f"ef={ef}"):
+                return run_phase(ef, None, gt_idx)
+        results = []
+        for sel, lt, fgt in filtered:
+            log(f"[{b.label}] Filtered search: selectivity {sel:g} ({FILTER_FIELD} < {lt}), ef={ef}")
+            with tracing.span(f"ef={ef} selectivity={sel:g}", filter_lt=lt):
+                phase = run_phase(ef, lt, fgt)
+            for r in phase:
+                r["selectivity"] = sel
+                r["filter_lt"] = lt
+                r["payload_index"] = bool(CONF.get("filtered_search", {}).get("payload_index", True))
+                results.append(r)
+        return results
 
+    def run_phase(ef, flt, gt_idx):
+        topk = CONF["topk"]
+        b.set_ef(conn, ef)
+        search = lambda qs: b.search(conn, qs, topk, ef, flt)
+        search_batch = lambda qs, bs: b.batch_search(conn, qs, topk, ef, bs, flt)
+        if ARGS.mixed:
+            before = quality_check(b.label, search, gt_idx, queries, extra=f"ef={ef}, before writes, ")
+            results = run_concurrency_grid(b.container, CONF["run_seconds"], queries,
+                                           make_mixed_callable(search, search_batch, write, gt_idx, **mixed_opts()),
+                                           budget_s=ARGS.budget_s, batch_sizes=CONF.get("query_batch_size_grid"))
+            for r in results:
+                # writes avoid GT ids and GT neighbourhoods (make_mutation_op guard): drift is index degradation
+                r["recall_before_writes"] = before["recall"]
+                r["recall_drift"] = r.get(f"load_recall@{topk}", float("nan")) - before["recall"]
+        elif ARGS.open_loop:
+            results = run_offered_load_grid(b.container, CONF["run_seconds"], queries,
+                                            make_open_loop_callable(search, gt_idx, **open_loop_opts()),
+                                            budget_s=ARGS.budget_s)
+        elif ARGS.engine == "async":
+            search_async = lambda c, qs: b.search_async(c, qs, topk, ef, flt)
+            results = run_concurrency_grid(b.container, CONF["run_seconds"], queries,
+                                           make_async_search_callable(b.connect_async, search_async, gt_idx,
+                                                                      close=b.close_async),
+                                           budget_s=ARGS.budget_s, batch_sizes=CONF.get("query_batch_size_grid"),
+                                           conc_grid=CONF.get("async_concurrency_grid"), engine="async")
+        elif ARGS.engine == "process":
+            target = {"backend": type(b), "backend_kwargs": {"quantization": b.quant}, "topk": topk, "ef": ef,
+                      "filter_lt": flt}
+            results = run_concurrency_grid(b.container, CONF["run_seconds"], queries,
+                                           make_process_search_callable(target, gt_idx, **process_opts()),
+                                           budget_s=ARGS.budget_s, batch_sizes=CONF.get("query_batch_size_grid"),
+                                           engine="process")
+        else:
+            results = run_concurrency_grid(b.container, CONF["run_seconds"], queries,
+                                           make_search_callable(search, search_batch, gt_idx),
+                                           budget_s=ARGS.budget_s, batch_sizes=CONF.get("query_batch_size_grid"))
+        quality = quality_check(b.label, search, gt_idx, queries, extra=f"ef={ef}, ")
+
+        # Add backend, ef, recall and ingest stats to results
+        for r in results:
+            r["db"] = b.name
+            r["ef"] = ef
+            r.update(quality)
+            r.update(ingest)
         return results
 
+    # Sensitivity study: sweep search-time ef over the one index built above
+    if ARGS.sensitivity:
+        all_results = []
+        for ef in CONF.get("ef_grid", [64, 128, 192, 256]):
+            log(f"[{b.label}] Testing ef={ef}")
+            all_results.extend(run_ef(ef))
+        return all_results
+    return run_ef(CONF.get("ef", 64))
+
 
 # ---------------------------------------------------------
 # CLI
 # ---------------------------------------------------------
 if __name__ == "__main__":
     ap = argparse.ArgumentParser(description="Benchmark for Qdrant vs Weaviate")
-    ap.add_argument("--db", choices=["qdrant", "weaviate"], required=True, help="Database backend")
+    ap.add_argument("--db", choices=sorted(BACKENDS), required=True,
+                    help="Backend: qdrant / weaviate, or in-process exact / hnsw references")
     ap.add_argument("--dataset", required=True, help="Dataset name from config.yaml")
     ap.add_argument("--budget_s", type=int, default=300, help="Wall-clock limit (sec)")
     ap.add_argument("--sensitivity", action="store_true", help="Run sensitivity study (test different ef values)")
+    ap.add_argument("--open_loop", action="store_true", help="Open-loop load: sweep offered QPS instead of concurrency")
+    ap.add_argument("--filtered", action="store_true",
+                    help="Filtered search over config.yaml filtered_search.selectivity_grid")
+    ap.add_argument("--quant", default=None,
+                    help="Quantization variant(s) from config.yaml quantization.<db>: name[,name] or 'all'")
+    ap.add_argument("--mixed", action="store_true",
+                    help="Mixed workload: upserts/updates/deletes alongside searches (config.yaml mixed_workload)")
+    ap.add_argument("--engine", choices=["thread", "async", "process"], default=None,
+                    help="Closed-loop engine (default: config.yaml 'engine', else thread)")
+    ap.add_argument("--trace", action="store_true",
+                    help="Also write a Chrome/Perfetto trace of phases, sampled requests and monitors (config.yaml trace)")
     args = ap.parse_args()
     ARGS = args
 
     import yaml
     with open("config.yaml", "r") as f:
         CONF = yaml.safe_load(f)
+    ARGS.engine = ARGS.engine or CONF.get("engine", "thread")
+    if ARGS.mixed and ARGS.open_loop:
+        raise SystemExit("--mixed runs closed-loop and cannot be combined with --open_loop")
+    if ARGS.mixed and ARGS.engine != "thread":
+        raise SystemExit(f"--mixed runs on the thread engine and cannot be combined with --engine {ARGS.engine}")
+    # backend capabilities, checked before any ingest
+    cls = BACKENDS[ARGS.db]
+    if ARGS.engine == "async" and not ARGS.open_loop and not cls.supports_async:
+        raise SystemExit(f"--engine async is not supported by --db {ARGS.db}")
+    if ARGS.engine == "process" and not ARGS.open_loop and not cls.supports_processes:
+        raise SystemExit(f"--engine process is not supported by --db {ARGS.db} (index lives in this process)")
+    if ARGS.mixed and not cls.supports_writes:
+        raise SystemExit(f"--mixed is not supported by --db {ARGS.db}")
+    if ARGS.trace:
+        tracing.TRACER = tracing.Tracer(**CONF.get("trace", {}))
 
     ds = next(d for d in CONF["datasets"] if d["name"] == args.dataset)
 
-    # Load dataset
-    from datasets import make_or_load_dataset
-    vectors, queries = make_or_load_dataset(
-        root=CONF.get("data_root", "../datasets"),
-        name=ds["name"],
-        n=ds["n_vectors"],
-        dim=ds["dim"],
-        n_queries=ds["n_queries"],
-        seed=CONF.get("seed", 42),
-    )
-
-    if args.db == "qdrant":
-        out = run_qdrant(ds, vectors, queries)
-    elif args.db == "weaviate":
-        out = run_weaviate(ds, vectors, queries)
-    else:
-        raise SystemExit("Please specify --db qdrant|weaviate")
+    # Quantization variants (validated before the dataset is loaded)
+    variants = CONF.get("quantization", {}).get(args.db, {})
+    names = [None] if not ARGS.quant else (list(variants) if ARGS.quant == "all" else ARGS.quant.split(","))
+    if not names:
+        raise SystemExit(f"--quant {ARGS.quant}: config.yaml has no quantization variants for --db {args.db}")
+    for qname in names:
+        if qname is not None and qname not in variants:
+            raise SystemExit(f"Unknown quantization variant {qname!r} for {args.db}; "
+                             f"config has: {', '.join(variants) or 'none'}")
+
+    # Load dataset once (memory-mapped; shared by ingest, search and ground truth)
+    from datasets import dataset_metric, load_dataset
+    with tracing.span("load dataset", dataset=ds["name"]):
+        vectors, queries, neighbors = load_dataset(CONF.get("data_root", "../datasets"), ds, seed=CONF.get("seed", 42))
+    metric = dataset_metric(CONF.get("data_root", "../datasets"), ds)
+    log(f"Dataset {ds['name']} ({ds.get('format', 'synthetic')}): {vectors.shape[0]} x {vectors.shape[1]}, "
+        f"{len(queries)} queries, metric={metric}, ground truth {'provided' if neighbors is not None else 'computed'}")
+
+    # One full build + search cycle per quantization variant
+    out = []
+    for qname in names:
+        b = get_backend(args.db, quantization=variants.get(qname) if qname else None)
+        if qname:
+            log(f"[{b.label}] Quantization variant {qname}: {b.quant or 'full precision'}")
+        with tracing.span(b.label, quantization=qname or "none"):
+            rows = run_backend(b, ds, vectors, queries, neighbors, metric)
+        for r in rows:
+            r["quantization"] = qname or "none"
+        out.extend(rows)
 
     # Save to /results (mounted at project root)
     results_dir = "/results" if os.path.exists("/results") else "results"
     os.makedirs(results_dir, exist_ok=True)
     sensitivity_suffix = "_sensitivity" if ARGS.sensitivity else ""
-    out_path = f"{results_dir}/{args.db}_{args.dataset}{sensitivity_suffix}.json"
+    load_suffix = "_openloop" if ARGS.open_loop else ("" if ARGS.engine == "thread" else f"_{ARGS.engine}")
+    load_suffix += ("_filtered" if ARGS.filtered else "") + ("_mixed" if ARGS.mixed else "")
+    load_suffix += "_quant" if ARGS.quant else ""
+    out_path = f"{results_dir}/{args.db}_{args.dataset}{sensitivity_suffix}{load_suffix}.json"
     with open(out_path, "w") as f:
         json.dump(out, f, indent=2)
 
     log(f"Results saved to {out_path}")
+    if tracing.TRACER:
+        trace_path = tracing.TRACER.dump(out_path[:-len(".json")] + ".trace.json", db=args.db, dataset=args.dataset)
+        log(f"Trace saved to {trace_path} (open in ui.perfetto.dev or chrome://tracing)")
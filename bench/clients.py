@@ -1,9 +1,22 @@
 # /bench/clients.py
 
+import threading, time, uuid
 import numpy as np
 import weaviate
-from qdrant_client import QdrantClient
+from weaviate.gql.get import GetBuilder
+from weaviate.gql.multi_get import MultiGetBuilder
+from qdrant_client import AsyncQdrantClient, QdrantClient
 from qdrant_client.http import models as qm
+from utils import PhaseTimer, ingest_stats
+
+# Client-side time of search requests: serialize (query -> request), rpc (call
+# until the client library returns, incl. its own encode/decode; in the asyncio
+# engine also time spent on other coroutines), decode (response -> id array).
+CLIENT_PHASES = PhaseTimer()
+
+# Synthetic filter attribute (datasets.make_or_load_attributes): a permutation
+# of 0..n-1, so "sel_rank < s * n" matches exactly a fraction s of the points.
+FILTER_FIELD = "sel_rank"
 
 
 class WeaviateClient:
@@ -11,7 +24,12 @@ class WeaviateClient:
         # Default single-node HTTP endpoint from docker-compose
         return weaviate.Client("http://weaviate:8080")
 
-    def drop_recreate(self, client, classname, dim, metric, ef=None):
+    def drop_recreate(self, client, classname, dim, metric, ef=None, filter_index=None, quantization=None):
+        """filter_index None: no filter attribute; False: filterable (bitmap) only; True: plus range index.
+
+        quantization: {"type": "bq", "rescore_limit": n} is set at creation; PQ
+        needs training data, so it is enabled after ingest with enable_pq().
+        """
         # Delete class if exists
         try:
             if client.schema.exists(classname):
@@ -25,10 +43,16 @@ class WeaviateClient:
             except Exception:
                 pass
 
-        vic = {"distance": metric, "efConstruction": 200, "maxConnections": 16}
+        vic = {"distance": {"l2": "l2-squared"}.get(metric.lower(), metric.lower()), "efConstruction": 200,
+               "maxConnections": 16}
         if ef is not None:
             # Set ef as the default search ef for this class
             vic["ef"] = int(ef)
+        q = quantization or {}
+        if q.get("type") == "bq":
+            vic["bq"] = {"enabled": True}
+            if q.get("rescore_limit") is not None:
+                vic["bq"]["rescoreLimit"] = int(q["rescore_limit"])
 
         cls = {
             "class": classname,
@@ -39,27 +63,214 @@ class WeaviateClient:
                 {"name": "pid", "dataType": ["int"]},
             ],
         }
+        if filter_index is not None:
+            cls["properties"].append({"name": FILTER_FIELD, "dataType": ["int"], "indexFilterable": True,
+                                      "indexRangeFilters": bool(filter_index)})
         client.schema.create_class(cls)
 
-    def insert(self, client, classname, vectors, batch=2000):
-        """Insert vectors into Weaviate."""
+    def enable_pq(self, client, classname, segments=0, centroids=256, training_limit=100000, rescore_limit=None,
+                  **_):
+        """Turn on PQ for an already loaded class; Weaviate trains the codebook and compresses in place."""
+        pq = {"enabled": True, "segments": int(segments), "centroids": int(centroids),
+              "trainingLimit": int(training_limit)}
+        if rescore_limit is not None:
+            pq["rescoreLimit"] = int(rescore_limit)
+        client.schema.update_config(classname, {"vectorIndexConfig": {"pq": pq}})
+
+    def set_ef(self, client, classname, ef):
+        """Change the class's search-time ef in place (no re-index; -1 = dynamic ef)."""
+        client.schema.update_config(classname, {"vectorIndexConfig": {"ef": int(ef)}})
+
+    def index_status(self, client, classname):
+        """Shard-level indexing state from GET /nodes/{class}?output=verbose."""
+        resp = client._connection.get(path=f"/nodes/{classname}", params={"output": "verbose"})
+        shards = [s for n in resp.json().get("nodes", []) for s in (n.get("shards") or [])
+                  if s.get("class") == classname]
+        return {"ready": bool(shards) and all(s.get("vectorIndexingStatus", "READY") == "READY"
+                                              and not s.get("vectorQueueLength") for s in shards),
+                "points": sum(int(s.get("objectCount") or 0) for s in shards),
+                "indexed": None,
+                "compressed": bool(shards) and all(s.get("compressed") for s in shards)}
+
+    def insert(self, client, classname, vectors, batch=2000, parallel=4, retries=3,
+               target_latency_s=1.0, min_batch=100, max_batch=10000, attrs=None):
+        """Bulk-load vectors via POST /batch/objects from `parallel` workers.
+
+        Workers pull the next slice from a shared cursor; its size is rescaled
+        after every request towards target_latency_s. Objects get deterministic
+        UUIDs derived from pid, so retrying failed objects is idempotent.
+        attrs (optional, per row) is stored as the filter attribute.
+        Returns ingest throughput stats.
+        """
+        from concurrent.futures import ThreadPoolExecutor
         N = len(vectors)
-        with client.batch(batch_size=batch) as b:
-            for i in range(N):
-                v = vectors[i]
-                obj = {"pid": int(i)}
-                b.add_data_object(obj, class_name=classname, vector=v.tolist())
-
-    def search(self, client, classname, queries, topk, ef=64):
-        """Return array shape (nq, topk) with pid results."""
-        res = []
+        lock = threading.Lock()
+        state = {"cursor": 0, "batch": int(batch), "retried": 0}
+
+        def post(ids, chunk):
+            t = time.time()
+            resp = client._connection.post(path="/batch/objects",
+                                           weaviate_object={"objects": self._objects(
+                                               classname, ids, chunk, None if attrs is None else attrs[ids])})
+            lat = time.time() - t
+            if resp.status_code != 200:
+                return lat, list(range(len(ids)))
+            return lat, [j for j, r in enumerate(resp.json())
+                         if (r.get("result") or {}).get("errors")]
+
+        def worker():
+            while True:
+                with lock:
+                    s = state["cursor"]
+                    if s >= N:
+                        return
+                    e = min(s + state["batch"], N)
+                    state["cursor"] = e
+                ids = list(range(s, e))
+                chunk = np.asarray(vectors[s:e], dtype=np.float32)
+                for attempt in range(retries + 1):
+                    try:
+                        lat, failed = post(ids, chunk)
+                    except Exception:
+                        lat, failed = None, list(range(len(ids)))
+                    if lat is not None:
+                        # Dynamic batch sizing: scale by target/observed latency, at most 2x per step
+                        with lock:
+                            f = min(2.0, max(0.5, target_latency_s / max(lat, 1e-3)))
+                            state["batch"] = int(min(max_batch, max(min_batch, state["batch"] * f)))
+                    if not failed:
+                        break
+                    if attempt == retries:
+                        raise RuntimeError(f"Weaviate batch insert: {len(failed)} objects failed after {retries} retries")
+                    with lock:
+                        state["retried"] += len(failed)
+                    ids = [ids[j] for j in failed]
+                    chunk = chunk[failed]
+                    time.sleep(0.5 * (attempt + 1))
+
+        t0 = time.time()
+        with ThreadPoolExecutor(max_workers=max(1, int(parallel))) as ex:
+            futs = [ex.submit(worker) for _ in range(max(1, int(parallel)))]
+            for fu in futs:
+                fu.result()
+        stats = ingest_stats(N, vectors.shape[1], time.time() - t0)
+        stats["ingest_retried_objects"] = state["retried"]
+        stats["ingest_final_batch_size"] = state["batch"]
+        return stats
+
+    @staticmethod
+    def _objects(classname, ids, chunk, attrs=None):
+        # one tolist() per request; no per-object client-side batching work
+        objs = [{"class": classname, "id": str(uuid.UUID(int=i)), "properties": {"pid": i}, "vector": v}
+                for i, v in zip(ids, chunk.tolist())]
+        if attrs is not None:
+            for o, a in zip(objs, np.asarray(attrs, dtype=object).tolist()):
+                if a is not None:
+                    o["properties"][FILTER_FIELD] = int(a)
+        return objs
+
+    @staticmethod
+    def _where(filter_lt):
+        return {"path": [FILTER_FIELD], "operator": "LessThan", "valueInt": int(filter_lt)}
+
+    def upsert(self, client, classname, ids, vectors, attrs=None):
+        """Insert or replace objects by pid (same deterministic UUIDs as insert()).
+
+        Replacing drops properties not sent: attrs (per id, None = none) keeps the filter attribute.
+        """
+        resp = client._connection.post(path="/batch/objects", weaviate_object={
+            "objects": self._objects(classname, [int(i) for i in ids], np.asarray(vectors, dtype=np.float32),
+                                     attrs)})
+        errors = [r for r in resp.json() if (r.get("result") or {}).get("errors")] if resp.status_code == 200 else None
+        if errors is None or errors:
+            raise RuntimeError(f"Weaviate upsert failed: {resp.status_code} {errors or resp.text[:200]}")
+
+    def delete(self, client, classname, ids):
+        for i in ids:
+            resp = client._connection.delete(path=f"/objects/{classname}/{uuid.UUID(int=int(i))}")
+            if resp.status_code not in (204, 404):
+                raise RuntimeError(f"Weaviate delete of pid {i} failed: {resp.status_code}")
+
+    def search(self, client, classname, queries, topk, ef=64, filter_lt=None):
+        """Return array shape (nq, topk) with pid results, padded with -1."""
+        res = np.full((len(queries), int(topk)), -1, dtype=np.int64)
         for i, q in enumerate(queries):
+            t0 = time.perf_counter()
             qb = client.query.get(classname, ["pid"])
             qb = qb.with_near_vector({"vector": q.tolist(), "certainty": 0.0})
-            r = qb.with_limit(int(topk)).do()
+            if filter_lt is not None:
+                qb = qb.with_where(self._where(filter_lt))
+            qb = qb.with_limit(int(topk))
+            t1 = time.perf_counter()
+            r = qb.do()
+            t2 = time.perf_counter()
             objs = r.get("data", {}).get("Get", {}).get(classname, []) or []
-            res.append([int(o["pid"]) for o in objs])
-        return np.array(res, dtype=int)
+            res[i, :len(objs)] = [int(o["pid"]) for o in objs]
+            CLIENT_PHASES.add(serialize=t1 - t0, rpc=t2 - t1, decode=time.perf_counter() - t2)
+        return res
+
+    def search_batch(self, client, classname, queries, topk, ef=64, batch_size=32, filter_lt=None):
+        """Pack batch_size aliased nearVector Gets into one GraphQL request.
+
+        Returns (nq, topk) int array of pid padded with -1. ef is a class-level
+        setting in Weaviate, so it is not sent per query.
+        """
+        nq = len(queries)
+        out = np.full((nq, int(topk)), -1, dtype=np.int64)
+        bs = max(1, int(batch_size))
+        for s in range(0, nq, bs):
+            t0 = time.perf_counter()
+            gql = self._multi_near_vector(classname, queries[s:s + bs], topk, filter_lt)
+            t1 = time.perf_counter()
+            r = client.query.raw(gql)
+            t2 = time.perf_counter()
+            self._parse_multi(r, out[s:s + bs])
+            CLIENT_PHASES.add(serialize=t1 - t0, rpc=t2 - t1, decode=time.perf_counter() - t2)
+        return out
+
+    @staticmethod
+    def _multi_near_vector(classname, queries, topk, filter_lt=None):
+        """GraphQL string with one aliased (q0, q1, ...) nearVector Get per query."""
+        chunk = np.asarray(queries, dtype=np.float32).tolist()
+        builders = [
+            GetBuilder(classname, ["pid"], None)
+            .with_alias(f"q{j}")
+            .with_near_vector({"vector": v, "certainty": 0.0})
+            .with_limit(int(topk))
+            for j, v in enumerate(chunk)
+        ]
+        if filter_lt is not None:
+            builders = [b.with_where(WeaviateClient._where(filter_lt)) for b in builders]
+        return MultiGetBuilder(builders, None).build()
+
+    @staticmethod
+    def _parse_multi(r, out):
+        """Fill out[j] with the pids returned under alias qj."""
+        if r.get("errors"):
+            raise RuntimeError(f"Weaviate multi_get failed: {r['errors']}")
+        got = r.get("data", {}).get("Get", {}) or {}
+        for j in range(len(out)):
+            objs = got.get(f"q{j}") or []
+            out[j, :len(objs)] = np.fromiter((o["pid"] for o in objs), dtype=np.int64, count=len(objs))
+
+    def connect_async(self):
+        """Async HTTP session for the asyncio engine (create inside the running loop)."""
+        import httpx
+        return httpx.AsyncClient(base_url="http://weaviate:8080/v1", timeout=60.0,
+                                 limits=httpx.Limits(max_connections=None, max_keepalive_connections=1024))
+
+    async def search_async(self, session, classname, queries, topk, ef=64, filter_lt=None):
+        """One aliased GraphQL request for all queries; returns (nq, topk) pids padded with -1."""
+        out = np.full((len(queries), int(topk)), -1, dtype=np.int64)
+        t0 = time.perf_counter()
+        body = {"query": self._multi_near_vector(classname, queries, topk, filter_lt)}
+        t1 = time.perf_counter()
+        resp = await session.post("/graphql", json=body)
+        t2 = time.perf_counter()
+        resp.raise_for_status()
+        self._parse_multi(resp.json(), out)
+        CLIENT_PHASES.add(serialize=t1 - t0, rpc=t2 - t1, decode=time.perf_counter() - t2)
+        return out
 
 
 class QdrantClientHelper:
@@ -67,36 +278,169 @@ class QdrantClientHelper:
         # prefer_grpc for better throughput
         return QdrantClient(url="http://qdrant:6333", grpc_port=6334, prefer_grpc=True, timeout=60.0)
 
-    def drop_recreate(self, client, name, dim, metric, on_disk=True):
+    def connect_async(self):
+        """Async gRPC client for the asyncio engine (create inside the running loop)."""
+        return AsyncQdrantClient(url="http://qdrant:6333", grpc_port=6334, prefer_grpc=True, timeout=60)
+
+    async def search_async(self, client, name, queries, topk, ef_search=64, filter_lt=None, quantization=None):
+        """search (one query) or search_batch (several) as one awaitable request."""
+        out = np.full((len(queries), int(topk)), -1, dtype=np.int64)
+        t0 = time.perf_counter()
+        params = self._params(ef_search, quantization)
+        flt = self._filter(filter_lt)
+        vecs = np.asarray(queries, dtype=np.float32).tolist()
+        if len(vecs) == 1:
+            t1 = time.perf_counter()
+            hits = [await client.search(name, query_vector=vecs[0], query_filter=flt, limit=int(topk),
+                                        search_params=params)]
+        else:
+            reqs = [qm.SearchRequest(vector=v, filter=flt, limit=int(topk), params=params, with_payload=False,
+                                     with_vector=False) for v in vecs]
+            t1 = time.perf_counter()
+            hits = await client.search_batch(collection_name=name, requests=reqs)
+        t2 = time.perf_counter()
+        for j, hs in enumerate(hits):
+            out[j, :len(hs)] = [h.id for h in hs]
+        CLIENT_PHASES.add(serialize=t1 - t0, rpc=t2 - t1, decode=time.perf_counter() - t2)
+        return out
+
+    def drop_recreate(self, client, name, dim, metric, on_disk=True, filter_index=False, quantization=None):
+        """filter_index: create an integer payload index on the filter attribute.
+
+        quantization: {"type": "scalar" | "product" | "binary", "always_ram": bool,
+        "compression": "x16" (product), "quantile": 0.99 (scalar)}; originals stay
+        on disk (on_disk=True) and quantized vectors in RAM with always_ram.
+        """
         if client.collection_exists(name):
             client.delete_collection(name)
 
-        dist = qm.Distance.COSINE if metric.lower() == "cosine" else qm.Distance.DOT
+        dist = {"cosine": qm.Distance.COSINE, "l2": qm.Distance.EUCLID, "euclid": qm.Distance.EUCLID,
+                "dot": qm.Distance.DOT}[metric.lower()]
         client.create_collection(
             collection_name=name,
             vectors_config=qm.VectorParams(size=dim, distance=dist, on_disk=on_disk),
             hnsw_config=qm.HnswConfigDiff(m=16, ef_construct=200),
             optimizers_config=qm.OptimizersConfigDiff(memmap_threshold=20000) if on_disk else None,
+            quantization_config=self._quant_config(quantization),
         )
+        if filter_index:
+            client.create_payload_index(name, FILTER_FIELD, field_schema=qm.PayloadSchemaType.INTEGER, wait=True)
+
+    @staticmethod
+    def _quant_config(q):
+        t = (q or {}).get("type")
+        if not t:
+            return None
+        ram = bool(q.get("always_ram", True))
+        if t == "scalar":
+            return qm.ScalarQuantization(scalar=qm.ScalarQuantizationConfig(
+                type=qm.ScalarType.INT8, quantile=q.get("quantile"), always_ram=ram))
+        if t == "product":
+            return qm.ProductQuantization(product=qm.ProductQuantizationConfig(
+                compression=qm.CompressionRatio(q.get("compression", "x16")), always_ram=ram))
+        if t == "binary":
+            return qm.BinaryQuantization(binary=qm.BinaryQuantizationConfig(always_ram=ram))
+        raise ValueError(f"Unknown Qdrant quantization type: {t!r}")
+
+    @staticmethod
+    def _params(ef_search, q=None):
+        """SearchParams; with quantization, rescore / oversampling from the variant config."""
+        qp = None
+        if (q or {}).get("type"):
+            qp = qm.QuantizationSearchParams(ignore=False, rescore=bool(q.get("rescore", True)),
+                                             oversampling=q.get("oversampling"))
+        return qm.SearchParams(hnsw_ef=int(ef_search), quantization=qp)
+
+    @staticmethod
+    def _filter(filter_lt):
+        if filter_lt is None:
+            return None
+        return qm.Filter(must=[qm.FieldCondition(key=FILTER_FIELD, range=qm.Range(lt=int(filter_lt)))])
+
+    def index_status(self, client, name):
+        """Collection green with an idle optimizer = every segment is built."""
+        info = client.get_collection(name)
+        ok = getattr(info.optimizer_status, "value", info.optimizer_status) == "ok"
+        return {"ready": info.status == qm.CollectionStatus.GREEN and ok,
+                "points": int(info.points_count or 0),
+                "indexed": int(info.indexed_vectors_count or 0)}
 
-    def insert(self, client, name, vectors, batch=1000):
-        """Insert vectors into Qdrant."""
-        ids = np.arange(len(vectors)).tolist()
-        points = []
-        for i, vec in enumerate(vectors):
-            p = qm.PointStruct(id=ids[i], vector=vec.tolist())
-            points.append(p)
-        client.upsert(collection_name=name, points=points, wait=True)
-
-    def search(self, client, name, queries, topk, ef_search=64):
-        """Return array shape (nq, topk) with id results."""
-        out = []
-        for q in queries:
+    def insert(self, client, name, vectors, batch=1000, parallel=4, wait=True, attrs=None):
+        """Stream vectors into Qdrant in numpy slices of `batch` from `parallel` threads.
+
+        Each worker slices its own chunk (so memmap'd datasets are read lazily)
+        and sends it as a columnar Batch. With wait=False upserts return once
+        acknowledged, not applied. attrs (optional, per row) becomes the filter
+        payload. Returns ingest throughput stats.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        N = len(vectors)
+        bs = max(1, int(batch))
+
+        def upsert_chunk(s):
+            e = min(s + bs, N)
+            chunk = np.asarray(vectors[s:e], dtype=np.float32)
+            payloads = None if attrs is None else [{FILTER_FIELD: a} for a in attrs[s:e].tolist()]
+            client.upsert(collection_name=name,
+                          points=qm.Batch(ids=list(range(s, e)), vectors=chunk.tolist(), payloads=payloads),
+                          wait=wait)
+
+        t0 = time.time()
+        with ThreadPoolExecutor(max_workers=max(1, int(parallel))) as ex:
+            # list() re-raises the first failed upsert
+            list(ex.map(upsert_chunk, range(0, N, bs)))
+        return ingest_stats(N, vectors.shape[1], time.time() - t0)
+
+    def upsert(self, client, name, ids, vectors, attrs=None, wait=True):
+        """Insert or replace points; the payload is replaced too, so attrs (per id, None = none) keeps the filter attribute."""
+        payloads = None if attrs is None else [{} if a is None else {FILTER_FIELD: int(a)} for a in attrs]
+        client.upsert(collection_name=name, wait=wait,
+                      points=qm.Batch(ids=[int(i) for i in ids], vectors=np.asarray(vectors, dtype=np.float32).tolist(),
+                                      payloads=payloads))
+
+    def delete(self, client, name, ids, wait=True):
+        client.delete(collection_name=name, wait=wait, points_selector=qm.PointIdsList(points=[int(i) for i in ids]))
+
+    def search(self, client, name, queries, topk, ef_search=64, filter_lt=None, quantization=None):
+        """Return array shape (nq, topk) with id results, padded with -1."""
+        out = np.full((len(queries), int(topk)), -1, dtype=np.int64)
+        flt = self._filter(filter_lt)
+        params = self._params(ef_search, quantization)
+        for i, q in enumerate(queries):
+            t0 = time.perf_counter()
+            v = q.tolist()
+            t1 = time.perf_counter()
             hits = client.search(
                 name,
-                query_vector=q.tolist(),
+                query_vector=v,
+                query_filter=flt,
                 limit=int(topk),
-                search_params=qm.SearchParams(hnsw_ef=int(ef_search)),
+                search_params=params,
             )
-            out.append([int(h.id) for h in hits])
-        return np.array(out, dtype=int)
+            t2 = time.perf_counter()
+            out[i, :len(hits)] = [int(h.id) for h in hits]
+            CLIENT_PHASES.add(serialize=t1 - t0, rpc=t2 - t1, decode=time.perf_counter() - t2)
+        return out
+
+    def search_batch(self, client, name, queries, topk, ef_search=64, batch_size=64, filter_lt=None,
+                     quantization=None):
+        """Batched search via search_batch; returns (nq, topk) int array padded with -1."""
+        nq = len(queries)
+        out = np.full((nq, int(topk)), -1, dtype=np.int64)
+        params = self._params(ef_search, quantization)
+        flt = self._filter(filter_lt)
+        bs = max(1, int(batch_size))
+        for s in range(0, nq, bs):
+            t0 = time.perf_counter()
+            # one tolist() per batch instead of one per query
+            chunk = np.asarray(queries[s:s + bs], dtype=np.float32).tolist()
+            reqs = [qm.SearchRequest(vector=v, filter=flt, limit=int(topk), params=params,
+                                     with_payload=False, with_vector=False) for v in chunk]
+            t1 = time.perf_counter()
+            hits = client.search_batch(collection_name=name, requests=reqs)
+            t2 = time.perf_counter()
+            for j, hs in enumerate(hits):
+                ids = [h.id for h in hs]
+                out[s + j, :len(ids)] = ids
+            CLIENT_PHASES.add(serialize=t1 - t0, rpc=t2 - t1, decode=time.perf_counter() - t2)
+        return out
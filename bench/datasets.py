@@ -1,26 +1,277 @@
 # /bench/datasets.py
-import os, numpy as np, pathlib
+import os, glob, json, hashlib, numpy as np, pathlib
+try:
+    import h5py
+except ImportError:
+    h5py = None
+from utils import brute_force_topk
 
 rng = np.random.default_rng
 
+# Rows generated per chunk when writing synthetic data (bounds RAM independently of n)
+CHUNK_ROWS = 65536
+
 def ensure_dir(p): pathlib.Path(p).mkdir(parents=True, exist_ok=True)
 
-def make_or_load_dataset(root, name, n, dim, n_queries, seed=42):
-    """Load or generate synthetic dataset for benchmarking."""
+def write_chunked(path, rows, dim, fill, chunk_rows=CHUNK_ROWS):
+    """Write a (rows, dim) float32 .npy via memmap, fill(n) producing n rows at a time.
+
+    Data goes to path + '.tmp' first and is renamed when complete, so an
+    interrupted run never leaves a truncated file that looks valid.
+    """
+    tmp = path + ".tmp"
+    mm = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.float32, shape=(rows, dim))
+    for s in range(0, rows, chunk_rows):
+        e = min(s + chunk_rows, rows)
+        mm[s:e] = fill(e - s)
+    mm.flush()
+    del mm
+    os.replace(tmp, path)
+
+def _normalize(x):
+    return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+
+def clustered_fills(dim, seed, clusters=1024, spread=0.25, intrinsic_dim=64, query_drift=0.05,
+                    ambient_noise=0.02, **_):
+    """fill(k) functions for corpus and queries of a normalized mixture of Gaussians.
+
+    Cluster centres are unit vectors in a random intrinsic_dim-dimensional
+    subspace; points are centre + spread * N(0, I/intrinsic_dim), projected to
+    dim, plus ambient_noise * N(0, I/dim) off the subspace, then normalized.
+    Cluster sizes follow a Dirichlet(1) draw (uneven, like real topics).
+    Queries sample the same clusters around centres moved by query_drift.
+    Each call uses its own generator seeded by (seed, stream, call #), so memory
+    is one chunk plus the (clusters + dim) x intrinsic_dim model.
+    """
+    r = rng(seed)
+    d_int = min(int(intrinsic_dim), dim)
+    basis = np.linalg.qr(r.standard_normal((dim, d_int), dtype=np.float32))[0].T.astype(np.float32)
+    centres = _normalize(r.standard_normal((clusters, d_int), dtype=np.float32))
+    weights = r.dirichlet(np.ones(clusters))
+    q_centres = _normalize(centres + query_drift * r.standard_normal(centres.shape, dtype=np.float32)
+                           / np.sqrt(d_int, dtype=np.float32))
+
+    def make_fill(stream, c):
+        calls = [0]
+        def fill(k):
+            g = rng((seed, stream, calls[0])); calls[0] += 1
+            x = c[g.choice(clusters, size=k, p=weights)]
+            x += (spread / np.sqrt(d_int)) * g.standard_normal((k, d_int), dtype=np.float32)
+            x = x @ basis
+            x += (ambient_noise / np.sqrt(dim)) * g.standard_normal((k, dim), dtype=np.float32)
+            return _normalize(x)
+        return fill
+    return make_fill(0, centres), make_fill(1, q_centres)
+
+def make_or_load_dataset(root, name, n, dim, n_queries, seed=42, chunk_rows=CHUNK_ROWS, mmap_mode="r",
+                         generator=None):
+    """Load or generate synthetic dataset for benchmarking.
+
+    generator: {"type": "gaussian"} (default, isotropic noise) or
+    {"type": "clustered", ...clustered_fills params}. Parameters are recorded
+    in generator.json and the files regenerated when they change. Returns
+    read-only memmaps (mmap_mode=None loads into RAM instead); load once and
+    pass the same arrays to ingest, search and ground truth.
+    """
     droot = os.path.join(root, name)
     ensure_dir(droot)
     vec_path = os.path.join(droot, "vectors.npy")
     qry_path = os.path.join(droot, "queries.npy")
+    gen_path = os.path.join(droot, "generator.json")
+    gen = {"type": "gaussian", **(generator or {})}
+    meta = {**gen, "n": n, "dim": dim, "n_queries": n_queries, "seed": seed}
+    try:
+        with open(gen_path) as f:
+            stale = json.load(f) != meta
+    except (OSError, ValueError):
+        # datasets generated before generator.json existed are isotropic gaussian
+        stale = gen["type"] != "gaussian"
 
-    if not (os.path.exists(vec_path) and os.path.exists(qry_path)):
-        print("Generating synthetic dataset")
-        r = rng(seed)
-        vectors = r.normal(0.0, 1.0, size=(n, dim)).astype("float32")
-        queries = r.normal(0.0, 1.0, size=(n_queries, dim)).astype("float32")
-        np.save(vec_path, vectors)
-        np.save(qry_path, queries)
-    else:
-        vectors = np.load(vec_path)
-        queries = np.load(qry_path)
+    if stale or not (os.path.exists(vec_path) and os.path.exists(qry_path)):
+        print(f"Generating synthetic dataset ({gen['type']}, {n} x {dim})")
+        if gen["type"] == "clustered":
+            fill_vec, fill_qry = clustered_fills(dim, seed, **{k: v for k, v in gen.items() if k != "type"})
+        elif gen["type"] == "gaussian":
+            r = rng(seed)
+            fill_vec = fill_qry = lambda k: r.standard_normal(size=(k, dim), dtype=np.float32)
+        else:
+            raise ValueError(f"Unknown synthetic generator {gen['type']!r}")
+        write_chunked(vec_path, n, dim, fill_vec, chunk_rows)
+        write_chunked(qry_path, n_queries, dim, fill_qry, chunk_rows)
+        with open(gen_path, "w") as f:
+            json.dump(meta, f)
 
+    vectors = np.load(vec_path, mmap_mode=mmap_mode)
+    queries = np.load(qry_path, mmap_mode=mmap_mode)
     return vectors, queries
+
+# ---------------------------------------------------------
+# Standard ANN formats (read in place, never converted in RAM)
+# ---------------------------------------------------------
+VECS_DTYPES = {".fvecs": np.float32, ".ivecs": np.int32, ".bvecs": np.uint8}
+
+# ann-benchmarks "distance" attribute -> metric used by backends / ground truth
+HDF5_METRICS = {"angular": "cosine", "cosine": "cosine", "euclidean": "l2", "l2": "l2", "dot": "dot", "ip": "dot"}
+
+def read_vecs(path):
+    """(n, d) memmap view of an fvecs / ivecs / bvecs file.
+
+    Each record is an int32 dimension followed by d components; the view skips
+    the headers with a row stride, so rows are paged in only when sliced.
+    """
+    dtype = np.dtype(VECS_DTYPES[os.path.splitext(path)[1]])
+    d = int(np.fromfile(path, dtype=np.int32, count=1)[0])
+    if dtype.itemsize == 4:
+        raw = np.memmap(path, dtype=dtype, mode="r").reshape(-1, d + 1)
+        return raw[:, 1:]
+    raw = np.memmap(path, dtype=np.uint8, mode="r").reshape(-1, 4 + d)
+    return raw[:, 4:]
+
+def read_hdf5(path, key):
+    """Dataset `key` of an HDF5 file as a memmap when stored contiguous + uncompressed
+    (ann-benchmarks files are), else the lazily sliced h5py dataset (file stays open)."""
+    if h5py is None:
+        raise RuntimeError("h5py is not installed (pip install h5py) - required for HDF5 datasets")
+    f = h5py.File(path, "r")
+    dset = f[key]
+    offset = dset.id.get_offset()
+    if dset.chunks is None and dset.compression is None and offset is not None:
+        arr = np.memmap(path, dtype=dset.dtype, mode="r", offset=offset, shape=dset.shape)
+        f.close()
+        return arr
+    return dset
+
+def dataset_metric(root, ds):
+    """Metric of a config.yaml dataset entry (cosine / l2 / dot)."""
+    if ds.get("metric"):
+        return ds["metric"].lower()
+    if ds.get("format") == "hdf5" and h5py is not None:
+        with h5py.File(os.path.join(root, ds["path"]), "r") as f:
+            return HDF5_METRICS[str(f.attrs.get("distance", "angular")).lower()]
+    return "cosine"
+
+def dataset_files(root, ds):
+    """Source files of a dataset entry (fingerprinted for the ground-truth cache)."""
+    fmt = ds.get("format", "synthetic")
+    if fmt == "synthetic":
+        return ("vectors.npy", "queries.npy")
+    if fmt == "hdf5":
+        return (os.path.join(root, ds["path"]),)
+    return tuple(os.path.join(root, ds[k]) for k in ("vectors", "queries"))
+
+def load_dataset(root, ds, seed=42):
+    """vectors, queries, neighbors for a config.yaml `datasets` entry.
+
+    format: synthetic (default; generated .npy pair, see `generator`), fvecs / bvecs (vectors,
+    queries and optional neighbors (.ivecs) paths relative to data_root) or
+    hdf5 (ann-benchmarks file at path: train / test / neighbors). vectors are
+    read in place (memmap or h5py); queries are small and loaded as float32.
+    neighbors is the provided exact top-k (None if the dataset has none).
+    """
+    fmt = ds.get("format", "synthetic")
+    if fmt == "synthetic":
+        vectors, queries = make_or_load_dataset(root, ds["name"], ds["n_vectors"], ds["dim"], ds["n_queries"],
+                                                seed=seed, generator=ds.get("generator"))
+        return vectors, queries, None
+    if fmt == "hdf5":
+        path = os.path.join(root, ds["path"])
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Dataset {ds['name']}: {path} not found")
+        vectors, queries = read_hdf5(path, ds.get("train_key", "train")), read_hdf5(path, ds.get("test_key", "test"))
+        with h5py.File(path, "r") as f:
+            neighbors = np.asarray(f["neighbors"], dtype=np.int64) if "neighbors" in f else None
+    elif fmt in ("fvecs", "bvecs"):
+        paths = {k: os.path.join(root, ds[k]) for k in ("vectors", "queries", "neighbors") if ds.get(k)}
+        for p in paths.values():
+            if not os.path.exists(p):
+                raise FileNotFoundError(f"Dataset {ds['name']}: {p} not found")
+        vectors, queries = read_vecs(paths["vectors"]), read_vecs(paths["queries"])
+        neighbors = np.asarray(read_vecs(paths["neighbors"]), dtype=np.int64) if "neighbors" in paths else None
+    else:
+        raise ValueError(f"Dataset {ds['name']}: unknown format {fmt!r}")
+    if ds.get("dim") and vectors.shape[1] != ds["dim"]:
+        raise ValueError(f"Dataset {ds['name']}: dim {vectors.shape[1]} != config dim {ds['dim']}")
+    return vectors, np.asarray(queries[:ds.get("n_queries", len(queries))], dtype=np.float32), neighbors
+
+def make_or_load_attributes(root, name, n, seed=42):
+    """Filter attribute per vector: a seeded permutation of 0..n-1 (attrs_n{n}_s{seed}.npy).
+
+    "attr < round(s * n)" then matches exactly a fraction s of the dataset, for
+    any selectivity s, and matches are spread uniformly over the vectors.
+    Keyed by n and seed, so a regenerated dataset of another size gets its own.
+    """
+    ensure_dir(os.path.join(root, name))
+    path = os.path.join(root, name, f"attrs_n{int(n)}_s{int(seed)}.npy")
+    if not os.path.exists(path) or len(np.load(path, mmap_mode="r")) != n:
+        attrs = rng(seed + 1).permutation(n).astype(np.int32)
+        with open(path + ".tmp", "wb") as f:
+            np.save(f, attrs)
+        os.replace(path + ".tmp", path)
+    return np.load(path)
+
+def dataset_fingerprint(droot, files=("vectors.npy", "queries.npy")):
+    """Content hash (sha1) of the dataset files (relative to droot or absolute), cached in fingerprint.json.
+
+    The cached hash is reused while every file keeps its size and mtime; when a
+    file changes (e.g. the dataset is regenerated) the hash is recomputed and
+    ground-truth caches of the old content are deleted.
+    """
+    meta_path = os.path.join(droot, "fingerprint.json")
+    paths = [os.path.join(droot, f) for f in files]
+    stat = [[os.path.getsize(p), os.stat(p).st_mtime_ns] for p in paths]
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get("stat") == stat:
+            return meta["sha1"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    h = hashlib.sha1()
+    for p in paths:
+        with open(p, "rb") as f:
+            for block in iter(lambda: f.read(16 << 20), b""):
+                h.update(block)
+    sha = h.hexdigest()
+    for stale in glob.glob(os.path.join(droot, "gt_*.npy")):
+        if not stale.endswith(f"_{sha[:12]}.npy"):
+            os.remove(stale)
+    with open(meta_path, "w") as f:
+        json.dump({"sha1": sha, "stat": stat}, f)
+    return sha
+
+def load_or_compute_gt(root, name, vectors, queries, topk, metric, files=("vectors.npy", "queries.npy")):
+    """Exact top-k for queries, cached in data_root/name and returned as a memmap.
+
+    Keyed by dataset fingerprint (of `files`), metric, topk and query count.
+    """
+    droot = os.path.join(root, name)
+    ensure_dir(droot)
+    sha = dataset_fingerprint(droot, files)
+    gt_path = os.path.join(droot, f"gt_{metric.lower()}_k{int(topk)}_q{len(queries)}_{sha[:12]}.npy")
+    if not os.path.exists(gt_path):
+        print(f"Computing ground truth ({len(queries)} queries, k={topk}, {metric})")
+        gt = brute_force_topk(vectors, queries, topk, metric=metric)
+        with open(gt_path + ".tmp", "wb") as f:
+            np.save(f, gt)
+        os.replace(gt_path + ".tmp", gt_path)
+    return np.load(gt_path, mmap_mode="r")
+
+def load_or_compute_filtered_gt(root, name, vectors, queries, topk, metric, attrs, filter_lt,
+                                files=("vectors.npy", "queries.npy")):
+    """Exact top-k among vectors with attrs < filter_lt (padded with -1 if fewer match).
+
+    Same cache as load_or_compute_gt; the key adds the threshold and a hash of attrs.
+    """
+    droot = os.path.join(root, name)
+    sha = dataset_fingerprint(droot, files)
+    ah = hashlib.sha1(np.ascontiguousarray(attrs).tobytes()).hexdigest()[:8]
+    gt_path = os.path.join(droot, f"gt_{metric.lower()}_k{int(topk)}_q{len(queries)}_lt{int(filter_lt)}_{ah}"
+                                  f"_{sha[:12]}.npy")
+    if not os.path.exists(gt_path):
+        print(f"Computing filtered ground truth ({int((attrs < filter_lt).sum())} matching vectors, k={topk}, {metric})")
+        gt = brute_force_topk(vectors, queries, topk, metric=metric, attrs=attrs, filter_lt=filter_lt)
+        with open(gt_path + ".tmp", "wb") as f:
+            np.save(f, gt)
+        os.replace(gt_path + ".tmp", gt_path)
+    return np.load(gt_path, mmap_mode="r")
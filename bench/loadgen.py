@@ -0,0 +1,490 @@
+# /bench/loadgen.py
+"""Load generators: closed loop (threads, asyncio or processes) and open loop (fixed/Poisson arrivals).
+
+Both return callables whose result is (qps, LatencyHistogram, extra_dict), the
+shape bench.measure_run expects. Every request is timed individually into a
+per-thread histogram; histograms are merged when the run ends. When tracing is
+on (tracing.TRACER), a sample of requests is also recorded as trace spans,
+and PROFILER (a monitoring.StackSampler) samples the worker threads; neither
+reaches --engine process workers, which run in their own processes.
+"""
+import asyncio, queue, time, threading, numpy as np
+import tracing
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from metrics import QualityAccumulator
+from utils import LatencyHistogram, pairwise_scores
+
+PROFILER = None  # set by bench.measure_run when client_profile.enabled
+
+def _register_worker():
+    if PROFILER: PROFILER.add_thread()
+
+# ---------------------------------------------------------
+# Closed loop
+# ---------------------------------------------------------
+def closed_loop(search, search_batch, gt_idx, qs, secs, conc, bs=1):
+    """Thread-pool closed loop over qs; returns (queries_done, LatencyHistogram, QualityAccumulator).
+
+    Each of `conc` workers cycles through its slice of qs, one request of bs
+    queries at a time (bs=1 -> search(), else search_batch()), and records every
+    request's latency. search / search_batch return padded (nq, topk) ids;
+    results are buffered per pass and scored against gt_idx (queries beyond
+    len(gt_idx) are skipped), so quality covers all queries issued.
+    """
+    stop_at = time.time() + secs
+    chunks = np.array_split(qs, conc)
+    offsets = np.cumsum([0] + [len(c) for c in chunks[:-1]])
+    hist = LatencyHistogram()
+    quality = QualityAccumulator()
+    tr = tracing.TRACER
+
+    def worker(batch, off):
+        _register_worker()
+        done = 0
+        h = LatencyHistogram()
+        acc = QualityAccumulator()
+        n_gt = 0 if gt_idx is None else max(0, min(len(batch), len(gt_idx) - off))
+        gt_w = np.asarray(gt_idx[off:off + n_gt]) if n_gt else None
+        res_buf = None
+        while time.time() < stop_at:
+            filled = 0
+            for s in range(0, len(batch), bs):
+                if time.time() >= stop_at:
+                    break
+                sub = batch[s:s + bs]
+                t_start = time.perf_counter()
+                res = search_batch(sub, bs) if bs > 1 else search(sub)
+                t_end = time.perf_counter()
+                h.record(t_end - t_start)
+                if tr: tr.request(t_start, t_end, queries=len(sub))
+                done += len(sub)
+                if n_gt and s < n_gt:
+                    if res_buf is None:
+                        res_buf = np.full((n_gt, res.shape[1]), -1, dtype=np.int64)
+                    n = min(len(sub), n_gt - s)
+                    res_buf[s:s + n] = res[:n]
+                    filled = s + n
+            if filled:
+                acc.add(gt_w[:filled], res_buf[:filled])
+        return done, h, acc
+
+    total = 0
+    with ThreadPoolExecutor(max_workers=conc) as ex:
+        futs = [ex.submit(worker, b, off) for b, off in zip(chunks, offsets) if len(b) > 0]
+        for fu in as_completed(futs):
+            worker_total, h, acc = fu.result()
+            total += worker_total
+            hist.merge(h)
+            quality.merge(acc)
+    return total, hist, quality
+
+
+def make_search_callable(search, search_batch, gt_idx=None):
+    """Closed-loop thread-pool callable fn(qs, secs, conc, bs) for run_concurrency_grid."""
+    def search_callable(qs, secs, conc, bs=1):
+        total, hist, quality = closed_loop(search, search_batch, gt_idx, qs, secs, conc, bs)
+        return total / float(secs), hist, quality.summary("load_")
+    return search_callable
+
+
+def make_async_search_callable(connect, search, gt_idx=None, close=None, score_every=1024):
+    """Closed-loop asyncio callable for run_concurrency_grid (same signature as the thread one).
+
+    conc is the number of in-flight requests: conc coroutines on one event loop
+    each await search(client, qs) in turn, pulling the next bs queries from a
+    shared cursor that wraps around qs, so conc may far exceed len(qs).
+    connect() builds the async client inside the loop; close(client) is awaited
+    at the end. Results are scored against gt_idx in batches of score_every.
+    """
+    def search_callable(qs, secs, conc, bs=1):
+        nq = len(qs)
+        n_gt = 0 if gt_idx is None else min(nq, len(gt_idx))
+        gt_w = np.asarray(gt_idx[:n_gt]) if n_gt else None
+        hist = LatencyHistogram()
+        quality = QualityAccumulator()
+        state = {"cursor": 0, "done": 0, "idx": [], "res": []}
+        tr = tracing.TRACER
+
+        def flush():
+            if state["idx"]:
+                quality.add(gt_w[state["idx"]], np.concatenate(state["res"]))
+                state["idx"], state["res"] = [], []
+
+        async def worker(client, stop_at):
+            loop = asyncio.get_running_loop()
+            while loop.time() < stop_at:
+                s = state["cursor"] % nq
+                state["cursor"] += bs
+                ids = [(s + j) % nq for j in range(min(bs, nq))]
+                t_start = time.perf_counter()
+                res = await search(client, qs[ids])
+                t_end = time.perf_counter()
+                hist.record(t_end - t_start)
+                if tr: tr.request(t_start, t_end, queries=len(ids))
+                state["done"] += len(ids)
+                keep = [j for j, i in enumerate(ids) if i < n_gt]
+                if keep:
+                    state["idx"].extend(ids[j] for j in keep)
+                    state["res"].append(res[keep])
+                    if len(state["idx"]) >= score_every:
+                        flush()
+
+        async def main():
+            _register_worker()  # every coroutine runs on this thread
+            client = connect()
+            try:
+                stop_at = asyncio.get_running_loop().time() + secs
+                await asyncio.gather(*(worker(client, stop_at) for _ in range(conc)))
+            finally:
+                if close is not None:
+                    await close(client)
+
+        asyncio.run(main())
+        flush()
+        return state["done"] / float(secs), hist, quality.summary("load_")
+    return search_callable
+
+# ---------------------------------------------------------
+# Mixed read/write
+# ---------------------------------------------------------
+def make_mutation_op(upsert, delete, vectors, protected_ids, mix=None, write_batch=1, noise=0.01, seed=0,
+                     attrs=None, guard=(), metric="COSINE", margin=0.01, max_draws=100):
+    """Thread-safe write(): one upsert / update / delete of write_batch points.
+
+    Only ids outside protected_ids (the ground-truth top-k of the recall
+    queries) are updated or deleted; new / updated vectors are jittered
+    copies of such points. A copy could still land in a recall query's true
+    top-k, so each generated row is checked against guard = [(queries, gt,
+    filter_lt or None), ...] and redrawn unless it scores (metric) below every
+    query's k-th neighbour by a relative margin (filtered sets: only rows whose
+    attribute passes the filter). With both, the static ground truth holds
+    under writes and a recall change is index degradation. New ids start at
+    len(vectors). upsert(ids, rows, row_attrs) / delete(ids) talk to the backend;
+    with attrs (the --filtered attribute per vector) updates resend each
+    point's attribute so it stays in its filters; new ids get none (None).
+    """
+    mix = mix or {"upsert": 0.5, "update": 0.3, "delete": 0.2}
+    kinds = list(mix)
+    p = np.asarray([mix[k] for k in kinds], dtype=np.float64)
+    p /= p.sum()
+    cand = np.setdiff1d(np.arange(len(vectors)), np.unique(np.asarray(protected_ids)))
+    live = cand.tolist()
+    rng = np.random.default_rng(seed)
+    lock = threading.Lock()
+    state = {"next_id": len(vectors)}
+
+    def fetch(ids):
+        # unique increasing ids: also valid fancy indexing for h5py-backed datasets
+        uniq, inv = np.unique(ids, return_inverse=True)
+        return np.asarray(vectors[uniq], dtype=np.float32)[inv]
+
+    # per guarded query: score of its k-th true neighbour minus the margin (-inf: fewer than k exist)
+    bounds = []
+    for q, gt, lt in guard:
+        q, gt = np.asarray(q, dtype=np.float32)[:len(gt)], np.asarray(gt)
+        valid = (gt >= 0).sum(axis=1)
+        kth = np.full(len(gt), -np.inf, dtype=np.float32)
+        has = np.flatnonzero(valid == gt.shape[1])  # padded rows: any passing row would join the top-k
+        if len(has):
+            s = np.diag(pairwise_scores(q[has], fetch(gt[has, valid[has] - 1]), metric))
+            kth[has] = s - margin * np.abs(s)
+        bounds.append((q, kth, lt))
+
+    def rejected(x, row_attrs):
+        bad = np.zeros(len(x), dtype=bool)
+        for q, kth, lt in bounds:
+            hit = (pairwise_scores(q, x, metric) >= kth[:, None]).any(axis=0)
+            if lt is not None:
+                hit &= np.array([a is not None and a < lt for a in row_attrs], dtype=bool)
+            bad |= hit
+        return bad
+
+    def draw(n):
+        src = fetch(rng.choice(cand, n))
+        return src + noise * src.std(axis=1, keepdims=True) * rng.standard_normal(src.shape, dtype=np.float32)
+
+    def rows(row_attrs):
+        x = draw(len(row_attrs))
+        for _ in range(max_draws):
+            bad = rejected(x, row_attrs)
+            if not bad.any():
+                return x
+            x[bad] = draw(int(bad.sum()))
+        raise RuntimeError("mixed workload: no row outside the recall queries' top-k after "
+                           f"{max_draws} draws (lower mixed_workload.gt_margin)")
+
+    def write():
+        with lock:
+            kind = kinds[rng.choice(len(kinds), p=p)]
+            if kind != "upsert" and len(live) <= write_batch:
+                kind = "upsert"
+            if kind == "upsert":
+                ids = list(range(state["next_id"], state["next_id"] + write_batch))
+                state["next_id"] += write_batch
+                live.extend(ids)
+            else:
+                pos = rng.choice(len(live), write_batch, replace=False)
+                ids = [live[i] for i in pos]
+                if kind == "delete":
+                    # swap-remove, highest position first
+                    for i in sorted(pos, reverse=True):
+                        live[i] = live[-1]; live.pop()
+            row_attrs = [int(attrs[i]) if attrs is not None and i < len(attrs) else None for i in ids]
+            data = rows(row_attrs) if kind != "delete" else None
+            if attrs is None:
+                row_attrs = None
+        if kind == "delete":
+            delete(ids)
+        else:
+            upsert(ids, data, row_attrs)
+        return kind
+    return write
+
+
+def make_mixed_callable(search, search_batch, write, gt_idx=None, read_write_ratio=10.0, writers=1):
+    """Closed-loop search (as make_search_callable) with a concurrent write stream.
+
+    `writers` threads call write() (see make_mutation_op) whenever fewer than
+    queries_done / read_write_ratio writes have been issued, so the ratio holds
+    whatever the read throughput. Search and write latencies are kept in
+    separate histograms; write stats are reported with a write_ prefix.
+    """
+    def search_callable(qs, secs, conc, bs=1):
+        lock = threading.Lock()
+        state = {"reads": 0, "writes": 0, "kinds": {}}
+        stop = threading.Event()
+        whist = LatencyHistogram()
+        tr = tracing.TRACER
+
+        def counted(fn):
+            def wrapped(q, *a):
+                res = fn(q, *a)
+                with lock:
+                    state["reads"] += len(q)
+                return res
+            return wrapped
+
+        def writer():
+            _register_worker()
+            h = LatencyHistogram()
+            while not stop.is_set():
+                with lock:
+                    due = state["writes"] < state["reads"] / read_write_ratio
+                    if due:
+                        state["writes"] += 1
+                if not due:
+                    time.sleep(0.0005)
+                    continue
+                t_start = time.perf_counter()
+                kind = write()
+                t_end = time.perf_counter()
+                h.record(t_end - t_start)
+                if tr: tr.request(t_start, t_end, name=f"write {kind}")
+                with lock:
+                    state["kinds"][kind] = state["kinds"].get(kind, 0) + 1
+            return h
+
+        with ThreadPoolExecutor(max_workers=writers) as ex:
+            futs = [ex.submit(writer) for _ in range(writers)]
+            try:
+                total, hist, quality = closed_loop(counted(search), counted(search_batch), gt_idx, qs, secs, conc, bs)
+            finally:
+                stop.set()
+            for fu in futs:
+                whist.merge(fu.result())
+
+        n_w = sum(state["kinds"].values())
+        extra = quality.summary("load_")
+        extra.update({f"write_{k}": v for k, v in whist.summary().items()})
+        extra.update({f"write_{k}s": v for k, v in state["kinds"].items()})
+        extra.update({"write_ops_per_s": n_w / float(secs), "read_write_ratio": read_write_ratio,
+                      "achieved_read_write_ratio": total / n_w if n_w else float("inf")})
+        return total / float(secs), hist, extra
+    return search_callable
+
+# ---------------------------------------------------------
+# Multi-process
+# ---------------------------------------------------------
+def _share(arr):
+    """Copy arr into a new SharedMemory block; returns (shm, spec) for _attach()."""
+    arr = np.ascontiguousarray(arr)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, arr.nbytes))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+
+def _attach(spec):
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+def _process_main(target, q_spec, gt_spec, lo, hi, secs, conc, bs, barrier, out_q):
+    """Worker process: own connection, zero-copy view of queries[lo:hi], closed loop."""
+    shms = []
+    try:
+        shm, qs = _attach(q_spec); shms.append(shm)
+        gt = None
+        if gt_spec is not None:
+            shm, gt = _attach(gt_spec); shms.append(shm)
+            gt = gt[lo:min(hi, len(gt))]
+        backend = target["backend"](**target.get("backend_kwargs", {}))
+        conn = backend.connect()
+        topk, ef, flt = target["topk"], target["ef"], target.get("filter_lt")
+        search = lambda q: backend.search(conn, q, topk, ef, flt)
+        search_batch = lambda q, b: backend.batch_search(conn, q, topk, ef, b, flt)
+        barrier.wait()
+        out_q.put(closed_loop(search, search_batch, gt, qs[lo:hi], secs, conc, bs))
+    except Exception as e:
+        try: barrier.abort()
+        except Exception: pass
+        out_q.put(RuntimeError(f"load worker {lo}:{hi} failed: {e!r}"))
+    finally:
+        for shm in shms:
+            shm.close()
+
+
+def make_process_search_callable(target, gt_idx=None, processes=4, start_timeout=60.0):
+    """Closed-loop callable fn(qs, secs, conc, bs) spread over worker processes.
+
+    target = {"backend": backends.Backend subclass, "backend_kwargs": {...},
+    "topk": k, "ef": ef, "filter_lt": optional filter threshold}; each
+    process instantiates the backend and opens its own connection, so
+    client-side capacity scales with cores instead of one GIL. Queries and
+    ground truth are placed in shared memory once per call and mapped by the
+    workers without copying; conc threads and the queries are split across
+    min(processes, conc) processes, whose histograms and quality accumulators
+    are merged in the parent. Processes are spawned (forking a live gRPC
+    channel is unsafe) and synchronised on a barrier, so startup is not timed.
+    """
+    def search_callable(qs, secs, conc, bs=1):
+        ctx = mp.get_context("spawn")
+        n_proc = max(1, min(int(processes), conc, len(qs)))
+        q_shm, q_spec = _share(np.asarray(qs, dtype=np.float32))
+        gt_shm, gt_spec = _share(np.asarray(gt_idx)) if gt_idx is not None else (None, None)
+        barrier = ctx.Barrier(n_proc + 1)
+        out_q = ctx.Queue()
+        bounds = np.cumsum([0] + [len(c) for c in np.array_split(np.arange(len(qs)), n_proc)])
+        threads = [len(c) for c in np.array_split(np.arange(conc), n_proc)]
+        procs = [ctx.Process(target=_process_main, daemon=True,
+                             args=(target, q_spec, gt_spec, int(bounds[i]), int(bounds[i+1]), secs,
+                                   threads[i], bs, barrier, out_q))
+                 for i in range(n_proc)]
+        try:
+            for p in procs:
+                p.start()
+            try:
+                barrier.wait(timeout=start_timeout)
+            except threading.BrokenBarrierError:
+                pass  # a worker failed to start; its error is on out_q
+            total = 0
+            hist = LatencyHistogram()
+            quality = QualityAccumulator()
+            for _ in procs:
+                try:
+                    r = out_q.get(timeout=secs + start_timeout)
+                except queue.Empty:
+                    raise RuntimeError("load worker process exited without a result") from None
+                if isinstance(r, Exception):
+                    raise r
+                done, h, acc = r
+                total += done
+                hist.merge(h)
+                quality.merge(acc)
+        finally:
+            for p in procs:
+                p.join(timeout=5)
+                if p.is_alive():
+                    p.terminate()
+            for shm in (q_shm, gt_shm):
+                if shm is not None:
+                    shm.close(); shm.unlink()
+        return total / float(secs), hist, {"processes": n_proc, **quality.summary("load_")}
+    return search_callable
+
+# ---------------------------------------------------------
+# Open loop
+# ---------------------------------------------------------
+def arrival_schedule(rate: float, secs: float, arrival: str = "poisson", seed=0) -> np.ndarray:
+    """Intended send offsets (s) in [0, secs) for a fixed or Poisson process at `rate` qps.
+
+    seed: int or sequence of ints (anything np.random.default_rng accepts).
+    """
+    if arrival == "fixed":
+        return np.arange(0.0, secs, 1.0 / rate)
+    if arrival != "poisson":
+        raise ValueError(f"Unknown arrival process: {arrival}")
+    r = np.random.default_rng(seed)
+    gaps = r.exponential(1.0 / rate, size=int(rate * secs * 1.2) + 16)
+    t = np.cumsum(gaps)
+    while t[-1] < secs:
+        t = np.concatenate([t, t[-1] + np.cumsum(r.exponential(1.0 / rate, size=len(gaps)))])
+    return t[t < secs]
+
+
+def make_open_loop_callable(search, gt_idx=None, arrival="poisson", max_inflight=256, seed=0,
+                            late_threshold_ms=1.0):
+    """Open-loop callable fn(qs, secs, rate, repeat=0): one query per request on a precomputed schedule.
+
+    The arrival sequence is seeded from (seed, rate, repeat), so repeats draw
+    independent schedules and stay reproducible across invocations.
+
+    Latency is measured from the *intended* send time, so queueing behind slow
+    requests is charged to the request (no coordinated omission). Up to
+    max_inflight requests are outstanding; when all are busy, sends start late
+    and "late_sends" counts those later than late_threshold_ms.
+    """
+    def open_loop_callable(qs, secs, rate, repeat=0):
+        sched = arrival_schedule(rate, secs, arrival, [int(seed), int(round(rate * 1000)), int(repeat)])
+        nq = len(qs)
+        lock = threading.Lock()
+        cursor = [0]
+        start = time.perf_counter() + 0.05
+        tr = tracing.TRACER
+
+        def worker():
+            _register_worker()
+            done = late = 0
+            h = LatencyHistogram()
+            acc = QualityAccumulator()
+            while True:
+                with lock:
+                    i = cursor[0]
+                    cursor[0] += 1
+                if i >= len(sched):
+                    return done, late, h, acc
+                intended = start + sched[i]
+                delay = intended - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                elif -delay * 1000 > late_threshold_ms:
+                    late += 1
+                qi = i % nq
+                res = search(qs[qi:qi + 1])
+                t_end = time.perf_counter()
+                h.record(t_end - intended)
+                # span starts at the intended send time: queueing delay is part of it
+                if tr: tr.request(intended, t_end, late_ms=max(0.0, -delay * 1000))
+                done += 1
+                if gt_idx is not None and qi < len(gt_idx):
+                    acc.add(gt_idx[qi:qi + 1], res)
+
+        total = late_total = 0
+        hist = LatencyHistogram()
+        quality = QualityAccumulator()
+        n_workers = max(1, min(int(max_inflight), len(sched)))
+        with ThreadPoolExecutor(max_workers=n_workers) as ex:
+            futs = [ex.submit(worker) for _ in range(n_workers)]
+            for fu in as_completed(futs):
+                done, late, h, acc = fu.result()
+                total += done
+                late_total += late
+                hist.merge(h)
+                quality.merge(acc)
+        elapsed = time.perf_counter() - start
+
+        extra = {"achieved_qps": total / elapsed, "late_sends": late_total, **quality.summary("load_")}
+        return total / elapsed, hist, extra
+    return open_loop_callable
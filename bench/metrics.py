@@ -0,0 +1,97 @@
+# /bench/metrics.py
+"""Vectorized ranking-quality metrics over padded (nq, k) id arrays.
+
+Result rows may be shorter than k: pad with -1 (clients do this), pads never match.
+"""
+import numpy as np
+
+DEFAULT_KS = (1, 10, 100)
+
+def hit_matrix(gt: np.ndarray, res: np.ndarray, k: int) -> np.ndarray:
+    """Bool (nq, <=k): res[i, j] is one of the true top-k of query i."""
+    g = np.asarray(gt)[:, :k]; r = np.asarray(res)[:, :k]
+    return (r[:, :, None] == g[:, None, :]).any(axis=2) & (r >= 0)
+
+def query_recall(gt: np.ndarray, res: np.ndarray, k: int) -> np.ndarray:
+    """Per-query recall@k: hits over min(k, real GT ids), the same ideal ndcg() uses (0 if none)."""
+    n_rel = (np.asarray(gt)[:, :k] >= 0).sum(axis=1)
+    return hit_matrix(gt, res, k).sum(axis=1) / np.maximum(n_rel, 1)
+
+def reciprocal_rank(gt: np.ndarray, res: np.ndarray) -> np.ndarray:
+    """1/rank of the true nearest neighbour in each result row (0 if missing)."""
+    r = np.asarray(res)
+    m = (r == np.asarray(gt)[:, :1]) & (r >= 0)
+    found = m.any(axis=1)
+    return np.where(found, 1.0 / (m.argmax(axis=1) + 1), 0.0)
+
+def ndcg(gt: np.ndarray, res: np.ndarray, k: int) -> np.ndarray:
+    """Per-query nDCG@k with binary relevance (member of the true top-k).
+
+    The ideal DCG counts only real GT ids, so rows padded with -1 (filters
+    with fewer than k matches) still reach 1.0 for a perfect result.
+    """
+    h = hit_matrix(gt, res, k)
+    disc = 1.0 / np.log2(np.arange(k) + 2)
+    n_rel = (np.asarray(gt)[:, :k] >= 0).sum(axis=1)
+    ideal = np.concatenate([[0.0], np.cumsum(disc)])[n_rel]
+    return np.where(n_rel > 0, (h @ disc[:h.shape[1]]) / np.maximum(ideal, 1e-12), 0.0)
+
+class QualityAccumulator:
+    """Running recall@k / MRR / nDCG sums plus a per-query recall histogram.
+
+    Memory is fixed (one histogram of k+1 bins), so it can absorb every query
+    issued during a load phase; per-thread instances are combined with merge().
+    """
+    def __init__(self, ks=DEFAULT_KS):
+        self.ks = tuple(ks)
+        self.n = 0
+        self.sums = {}
+        self.kmax = None
+        self.hist = None
+
+    def add(self, gt: np.ndarray, res: np.ndarray):
+        gt = np.asarray(gt); res = np.asarray(res)
+        if len(gt) == 0: return self
+        if self.kmax is None:
+            # gt width is always reported, plus every requested k that fits
+            self.ks = tuple(sorted({k for k in self.ks if k <= gt.shape[1]} | {gt.shape[1]}))
+            self.kmax = self.ks[-1]
+            self.hist = np.zeros(self.kmax + 1, dtype=np.int64)
+        for k in self.ks:
+            self._add(f"recall@{k}", query_recall(gt, res, k).sum())
+        self._add("mrr", reciprocal_rank(gt, res).sum())
+        self._add(f"ndcg@{self.kmax}", ndcg(gt, res, self.kmax).sum())
+        # binned in kmax steps (floor), so padded rows land in the same bins as full ones
+        bins = np.floor(query_recall(gt, res, self.kmax) * self.kmax + 1e-9).astype(np.int64)
+        self.hist += np.bincount(bins, minlength=self.kmax + 1)
+        self.n += len(gt)
+        return self
+
+    def _add(self, key, v):
+        self.sums[key] = self.sums.get(key, 0.0) + float(v)
+
+    def merge(self, other: "QualityAccumulator"):
+        if other.n == 0: return self
+        if self.n == 0:
+            self.ks, self.kmax, self.hist = other.ks, other.kmax, other.hist.copy()
+        else:
+            self.hist += other.hist
+        for key, v in other.sums.items():
+            self._add(key, v)
+        self.n += other.n
+        return self
+
+    def summary(self, prefix: str = "") -> dict:
+        if self.n == 0: return {}
+        out = {f"{prefix}{key}": v / self.n for key, v in self.sums.items()}
+        # Per-query recall@kmax distribution (low tail matters most)
+        cdf = np.cumsum(self.hist) / self.n
+        for name, q in (("min", 0.0), ("p01", 0.01), ("p05", 0.05), ("p50", 0.50)):
+            hits = int(np.searchsorted(cdf, q, side="right" if q == 0.0 else "left"))
+            out[f"{prefix}recall@{self.kmax}_{name}"] = hits / self.kmax
+        out[f"{prefix}queries_evaluated"] = self.n
+        return out
+
+def quality_metrics(gt: np.ndarray, res: np.ndarray, ks=DEFAULT_KS, prefix: str = "") -> dict:
+    """recall@k (k in ks that fit gt), MRR, nDCG and per-query recall percentiles."""
+    return QualityAccumulator(ks).add(gt, res).summary(prefix)
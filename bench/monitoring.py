@@ -1,5 +1,6 @@
 # /bench/monitoring.py
-import os, time, json, threading, subprocess
+import os, re, sys, time, json, threading, subprocess, functools
+from collections import deque
 try:
     import docker
 except ImportError:
@@ -10,80 +11,429 @@ except ImportError:
     psutil = None
 from typing import Dict
 
-def sample_container_cpu(container_name: str, duration_s: int) -> float:
-    """Return average container CPU % over duration (docker stats compatible, fallback to psutil)."""
-    if docker:
+def _memory_mb(m: Dict) -> Dict[str, float]:
+    """Resident memory (usage minus reclaimable page cache, as `docker stats` shows) and the file cache on top."""
+    st = m.get("stats", {})
+    cache = st.get("inactive_file", st.get("total_inactive_file", 0))
+    return {"mem_resident_mb": (m["usage"] - cache) / 1e6, "mem_cache_mb": st.get("file", cache) / 1e6}
+
+def _blkio_bytes(s: Dict):
+    """(read, write) bytes from blkio_stats (cgroup v1 "Read"/"Write", v2 "read"/"write")."""
+    rd = wr = 0
+    for e in (s.get("blkio_stats") or {}).get("io_service_bytes_recursive") or []:
+        op = e.get("op", "").lower()
+        if op == "read": rd += e.get("value", 0)
+        elif op == "write": wr += e.get("value", 0)
+    return rd, wr
+
+class ContainerStatsCollector:
+    """Per-second CPU / memory / network / block I/O timeline for a set of containers.
+
+    One long-lived thread per watched container reads docker's streaming stats
+    endpoint (one sample per second; CPU from the embedded precpu_stats), so
+    there is no per-sample client setup, blocking call pair or sleep. Without
+    docker a single psutil thread samples the whole host as container "host".
+    Samples go to a bounded deque; since(t0) slices out one run's timeline.
+    """
+    def __init__(self, max_samples: int = 86400):
+        self.samples = deque(maxlen=max_samples)
+        self.lock = threading.Lock()
+        self.threads = {}
+        self.running = True
+        self.client = None
+        if docker:
+            try:
+                self.client = docker.from_env()
+            except Exception as e:
+                print(f"Docker stats unavailable: {e}, sampling the host with psutil")
+
+    def watch(self, container_name: str):
+        """Start streaming stats for container_name (idempotent)."""
+        name = container_name if self.client else "host"
+        if name in self.threads or (not self.client and not psutil):
+            return self
+        target = self._stream if self.client else self._host
+        t = threading.Thread(target=target, args=(name,), daemon=True)
+        self.threads[name] = t
+        t.start()
+        return self
+
+    def stop(self):
+        # stream threads exit at their next sample; daemon threads never block exit
+        self.running = False
+
+    def since(self, t0: float, t1: float = None) -> list:
+        """Samples taken in [t0, t1], with t relative to t0."""
+        t1 = t1 or time.time()
+        with self.lock:
+            return [{"t": round(s["ts"] - t0, 3), **{k: v for k, v in s.items() if k != "ts"}}
+                    for s in self.samples if t0 <= s["ts"] <= t1]
+
+    def latest(self, container_name: str) -> Dict:
+        """Most recent sample of container_name ("host" without docker), {} if none yet."""
+        name = container_name if self.client else "host"
+        with self.lock:
+            return next((dict(s) for s in reversed(self.samples) if s["container"] == name), {})
+
+    def _add(self, name, ts, prev, cur, **fields):
+        row = {"ts": ts, "container": name, **fields}
+        if prev is not None:
+            dt = max(ts - prev[0], 1e-3)
+            for k, v in cur.items():
+                row[f"{k}_mb_s"] = max(0.0, (v - prev[1][k]) / dt / 1e6)
+        with self.lock:
+            self.samples.append(row)
+
+    def _stream(self, name):
         try:
-            client = docker.from_env()
-            c = client.containers.get(container_name)
-            
-            # Get initial stats
-            stats1 = c.stats(stream=False)
-            cpu1 = stats1["cpu_stats"]["cpu_usage"]["total_usage"]
-            sys1 = stats1["cpu_stats"]["system_cpu_usage"]
-            online_cpus = stats1["cpu_stats"]["online_cpus"]
-            
-            time.sleep(duration_s)
-            
-            # Get final stats
-            stats2 = c.stats(stream=False)
-            cpu2 = stats2["cpu_stats"]["cpu_usage"]["total_usage"]
-            sys2 = stats2["cpu_stats"]["system_cpu_usage"]
-            
-            # Calculate CPU percentage
-            cpu_delta = cpu2 - cpu1
-            sys_delta = sys2 - sys1
-            
-            if sys_delta > 0:
-                cpu_percent = (cpu_delta / sys_delta) * online_cpus * 100.0
-                return max(0.0, cpu_percent)  # Ensure non-negative
-            else:
-                return 0.0
-                
+            stream = self.client.containers.get(name).stats(stream=True, decode=True)
         except Exception as e:
-            print(f"Docker stats failed: {e}, falling back to psutil")
+            print(f"Docker stats stream for {name} failed: {e}")
+            return
+        prev = None
+        for s in stream:
+            if not self.running:
+                break
+            ts = time.time()
+            cpu, pre = s.get("cpu_stats", {}), s.get("precpu_stats", {})
+            cpu_d = cpu.get("cpu_usage", {}).get("total_usage", 0) - pre.get("cpu_usage", {}).get("total_usage", 0)
+            sys_d = cpu.get("system_cpu_usage", 0) - pre.get("system_cpu_usage", 0)
+            cpu_pct = cpu_d / sys_d * cpu.get("online_cpus", 1) * 100.0 if sys_d > 0 and pre else 0.0
+            nets = (s.get("networks") or {}).values()
+            rd, wr = _blkio_bytes(s)
+            cur = {"net_rx": sum(n.get("rx_bytes", 0) for n in nets), "net_tx": sum(n.get("tx_bytes", 0) for n in nets),
+                   "blk_read": rd, "blk_write": wr}
+            mem = _memory_mb(s["memory_stats"]) if s.get("memory_stats", {}).get("usage") is not None else {}
+            self._add(name, ts, prev, cur, cpu_pct=max(0.0, cpu_pct), **mem)
+            prev = (ts, cur)
+
+    def _host(self, name):
+        prev = None
+        psutil.cpu_percent(interval=None)
+        while self.running:
+            time.sleep(1.0)
+            ts = time.time()
+            vm, net, disk = psutil.virtual_memory(), psutil.net_io_counters(), psutil.disk_io_counters()
+            cur = {"net_rx": net.bytes_recv, "net_tx": net.bytes_sent,
+                   "blk_read": disk.read_bytes if disk else 0, "blk_write": disk.write_bytes if disk else 0}
+            # docker scale: 100% per core
+            self._add(name, ts, prev, cur, cpu_pct=psutil.cpu_percent(interval=None) * (psutil.cpu_count() or 1),
+                      mem_resident_mb=(vm.total - vm.available) / 1e6,
+                      mem_cache_mb=getattr(vm, "cached", 0) / 1e6)
+            prev = (ts, cur)
+
+# ---------------------------------------------------------
+# Per-container I/O from cgroup v2
+# ---------------------------------------------------------
+def cgroup_root() -> str:
+    """Host cgroup v2 tree (mounted at /host/sys/fs/cgroup in the bench container)."""
+    return os.environ.get("CGROUP_ROOT") or next(
+        (p for p in ("/host/sys/fs/cgroup", "/sys/fs/cgroup") if os.path.isdir(p)), "/sys/fs/cgroup")
+
+@functools.lru_cache(maxsize=None)
+def cgroup_path(container_name: str, root: str = None):
+    """cgroup directory of a container (systemd or cgroupfs driver layout), None if not found; cached."""
+    if not docker:
+        return None
+    try:
+        cid = docker.from_env().containers.get(container_name).id
+    except Exception as e:
+        print(f"cgroup lookup for {container_name} failed: {e}")
+        return None
+    root = root or cgroup_root()
+    for rel in (f"system.slice/docker-{cid}.scope", f"docker/{cid}", f"kubepods/{cid}"):
+        if os.path.exists(os.path.join(root, rel, "io.stat")):
+            return os.path.join(root, rel)
+    # other layouts (rootless, nested): the tree is small enough to search
+    for dirpath, _, files in os.walk(root):
+        if cid in os.path.basename(dirpath) and "io.stat" in files:
+            return dirpath
+    return None
+
+MEMORY_STAT_KEYS = ("pgmajfault", "pgfault", "file", "file_mapped", "active_file", "inactive_file")
+
+def read_cgroup_counters(path: str) -> Dict[str, int]:
+    """io.stat (summed over devices) + selected memory.stat counters of one cgroup."""
+    out = {"rbytes": 0, "wbytes": 0, "rios": 0, "wios": 0}
+    with open(os.path.join(path, "io.stat")) as f:
+        for line in f:
+            # "259:0 rbytes=... wbytes=... rios=... wios=... dbytes=... dios=..."
+            for kv in line.split()[1:]:
+                k, _, v = kv.partition("=")
+                if k in out:
+                    out[k] += int(v)
+    with open(os.path.join(path, "memory.stat")) as f:
+        for line in f:
+            k, v = line.split()
+            if k in MEMORY_STAT_KEYS:
+                out[k] = int(v)
+    return out
+
+class CgroupIOMonitor:
+    """Block I/O and page faults of one container from its cgroup's io.stat / memory.stat.
+
+    Counters are read at start(), every interval_s and at stop(); unlike
+    IOMonitor this only counts the container's own I/O (not the bench process,
+    logs or other tenants). summary(queries) adds per-query ratios.
+    """
+    def __init__(self, container_name: str, interval_s: float = 1.0):
+        self.container_name = container_name
+        self.interval_s = interval_s
+        self.path = cgroup_path(container_name)
+        self.samples = []
+        self.running = False
+        self.thread = None
 
-    # Fallback to psutil for CPU monitoring
-    if psutil:
+    def _sample(self):
         try:
-            start_time = time.time()
-            start_cpu = psutil.cpu_percent(interval=None)
-            time.sleep(duration_s)
-            end_cpu = psutil.cpu_percent(interval=None)
-            return (start_cpu + end_cpu) / 2.0
-        except Exception as e:
-            print(f"psutil CPU monitoring failed: {e}")
-    return 0.0
+            self.samples.append((time.time(), read_cgroup_counters(self.path)))
+        except OSError as e:
+            print(f"cgroup read for {self.container_name} failed: {e}")
+
+    def start(self):
+        if self.path is None:
+            return self
+        self.running = True
+        self._sample()
+        def loop():
+            while self.running:
+                time.sleep(self.interval_s)
+                if self.running:
+                    self._sample()
+        self.thread = threading.Thread(target=loop, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.path is None:
+            return self
+        self.running = False
+        self.thread.join(timeout=self.interval_s + 1)
+        self._sample()
+        return self
+
+    def timeline(self) -> list:
+        """Per-interval deltas: MB/s, IOPS and faults/s."""
+        out = []
+        for (t_a, a), (t_b, b) in zip(self.samples, self.samples[1:]):
+            dt = max(t_b - t_a, 1e-3)
+            out.append({"t": round(t_b - self.samples[0][0], 3),
+                        "read_mb_s": (b["rbytes"] - a["rbytes"]) / dt / 1e6,
+                        "write_mb_s": (b["wbytes"] - a["wbytes"]) / dt / 1e6,
+                        "read_iops": (b["rios"] - a["rios"]) / dt, "write_iops": (b["wios"] - a["wios"]) / dt,
+                        "major_faults_s": (b.get("pgmajfault", 0) - a.get("pgmajfault", 0)) / dt,
+                        "file_mb": b.get("file", 0) / 1e6})
+        return out
+
+    def summary(self, queries: int = 0) -> Dict[str, float]:
+        """Run totals prefixed cg_ ({} if the cgroup was not found)."""
+        if len(self.samples) < 2:
+            return {}
+        (t_a, a), (t_b, b) = self.samples[0], self.samples[-1]
+        dt = max(t_b - t_a, 1e-3)
+        d = {k: b.get(k, 0) - a.get(k, 0) for k in ("rbytes", "wbytes", "rios", "wios", "pgmajfault", "pgfault")}
+        out = {
+            "cg_read_mb": d["rbytes"] / 1e6, "cg_write_mb": d["wbytes"] / 1e6,
+            "cg_read_iops": d["rios"] / dt, "cg_write_iops": d["wios"] / dt,
+            "cg_major_faults": d["pgmajfault"], "cg_minor_faults": d["pgfault"] - d["pgmajfault"],
+            "cg_file_mb": b.get("file", 0) / 1e6, "cg_file_mapped_mb": b.get("file_mapped", 0) / 1e6,
+        }
+        if queries:
+            out.update({"cg_read_kb_per_query": d["rbytes"] / 1e3 / queries,
+                        "cg_read_ios_per_query": d["rios"] / queries,
+                        "cg_major_faults_per_query": d["pgmajfault"] / queries})
+        return out
+
+# ---------------------------------------------------------
+# Bench process (client side)
+# ---------------------------------------------------------
+class ClientMonitor:
+    """CPU and GIL wait of the bench process itself during a run.
+
+    CPU comes from os.times() (this process plus worker processes joined
+    before stop()), in docker units (100 = one core). A probe thread sleeps
+    probe_s in a loop: how late it wakes up is time spent waiting for the GIL
+    (plus OS scheduling), which grows when the client's Python threads are
+    saturated.
+    """
+    def __init__(self, probe_s: float = 0.005):
+        self.probe_s = probe_s
+        self.running = False
+        self.thread = None
+        self.waits = []
+
+    @staticmethod
+    def _cpu_s():
+        t = os.times()
+        return t.user + t.system + t.children_user + t.children_system
+
+    def start(self):
+        self.t0, self.cpu0 = time.perf_counter(), self._cpu_s()
+        self.running = True
+        def probe():
+            while self.running:
+                t = time.perf_counter()
+                time.sleep(self.probe_s)
+                self.waits.append(max(0.0, time.perf_counter() - t - self.probe_s))
+        self.thread = threading.Thread(target=probe, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.elapsed, self.cpu = time.perf_counter() - self.t0, self._cpu_s() - self.cpu0
+        self.running = False
+        self.thread.join(timeout=1)
+        return self
+
+    def summary(self) -> Dict[str, float]:
+        waits = sorted(self.waits) or [0.0]
+        return {"client_cpu_pct": self.cpu / max(self.elapsed, 1e-9) * 100.0,
+                "client_gil_wait_ms_mean": sum(waits) / len(waits) * 1000,
+                "client_gil_wait_ms_p99": waits[min(len(waits) - 1, int(0.99 * len(waits)))] * 1000}
+
+class StackSampler:
+    """Sampling profiler for registered threads (the load generator's workers).
+
+    Every interval_s, the Python stack of each thread that called add_thread()
+    is read from sys._current_frames() and counted as a collapsed
+    "file:func;file:func;..." string (root first, as flamegraph.pl expects).
+    """
+    def __init__(self, interval_s: float = 0.005, depth: int = 40):
+        self.interval_s = interval_s
+        self.depth = depth
+        self.idents = set()
+        self.stacks = {}
+        self.samples = 0
+        self.running = False
+        self.thread = None
+
+    def add_thread(self):
+        self.idents.add(threading.get_ident())
+
+    def _collapse(self, frame) -> str:
+        parts = []
+        while frame is not None and len(parts) < self.depth:
+            co = frame.f_code
+            parts.append(f"{os.path.basename(co.co_filename)}:{co.co_name}")
+            frame = frame.f_back
+        return ";".join(reversed(parts))
+
+    def start(self):
+        self.running = True
+        def loop():
+            while self.running:
+                frames = sys._current_frames()
+                for ident in list(self.idents):
+                    f = frames.get(ident)
+                    if f is not None:
+                        key = self._collapse(f)
+                        self.stacks[key] = self.stacks.get(key, 0) + 1
+                        self.samples += 1
+                del frames
+                time.sleep(self.interval_s)
+        self.thread = threading.Thread(target=loop, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join(timeout=1)
+        return self
+
+    def top(self, n: int = 20) -> list:
+        """Most frequent stacks: [{"stack", "samples", "share"}, ...]."""
+        ranked = sorted(self.stacks.items(), key=lambda kv: -kv[1])[:n]
+        return [{"stack": k, "samples": v, "share": v / max(self.samples, 1)} for k, v in ranked]
+
+BPF_IO_SCRIPT = r'''
+tracepoint:block:block_rq_issue {FILTER}{
+    @bytes_hist = hist(args->bytes);
+    @total_bytes += args->bytes;
+    @io_count++;
+    if (args->rwbs[0] == "R") { @read_bytes += args->bytes; @read_count++; @read_size = hist(args->bytes); }
+    else if (args->rwbs[0] == "W") { @write_bytes += args->bytes; @write_count++; @write_size = hist(args->bytes); }
+    @start[args->dev, args->sector] = nsecs;
+    @inflight++;
+}
+tracepoint:block:block_rq_complete /@start[args->dev, args->sector]/ {
+    $us = (nsecs - @start[args->dev, args->sector]) / 1000;
+    if (args->rwbs[0] == "R") { @read_lat_us = hist($us); }
+    else if (args->rwbs[0] == "W") { @write_lat_us = hist($us); }
+    delete(@start[args->dev, args->sector]);
+    @inflight--;
+}
+interval:ms:{QD_MS} {
+    printf("QD %d %d\n", elapsed / 1000000, @inflight);
+}
+END {
+    printf("=== FINAL STATS ===\n");
+    printf("Total bytes: %d\n", @total_bytes);
+    printf("Read bytes: %d\n", @read_bytes);
+    printf("Write bytes: %d\n", @write_bytes);
+    printf("Total IOPS: %d\n", @io_count);
+    printf("Read IOPS: %d\n", @read_count);
+    printf("Write IOPS: %d\n", @write_count);
+    print(@bytes_hist); print(@read_size); print(@write_size); print(@read_lat_us); print(@write_lat_us);
+    clear(@bytes_hist); clear(@read_size); clear(@write_size); clear(@read_lat_us); clear(@write_lat_us);
+    clear(@start); clear(@inflight); clear(@total_bytes); clear(@io_count);
+    clear(@read_bytes); clear(@read_count); clear(@write_bytes); clear(@write_count);
+}'''
+
+IO_HISTS = {"read_size": "read_size_bytes", "write_size": "write_size_bytes",
+            "read_lat_us": "read_lat_us", "write_lat_us": "write_lat_us"}
+_HIST_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+_HIST_LINE = re.compile(r"^\[(\d+)([KMGT]?)(?:,\s*(\d+)([KMGT]?))?[)\]]\s+(\d+)")
+
+def parse_bpftrace_hists(out: str) -> Dict[str, list]:
+    """bpftrace hist() maps -> {map: [{"lo", "hi", "count"}, ...]} (hi exclusive; "[0]" is lo=hi=0)."""
+    hists, cur = {}, None
+    for line in out.splitlines():
+        line = line.strip()
+        m = _HIST_LINE.match(line) if cur is not None else None
+        if line.startswith("@") and line.endswith(":"):
+            cur = hists.setdefault(line[1:-1], [])
+        elif m:
+            lo = int(m[1]) * _HIST_UNITS[m[2]]
+            hi = int(m[3]) * _HIST_UNITS[m[4]] if m[3] else lo
+            cur.append({"lo": lo, "hi": hi, "count": int(m[5])})
+        elif not line:
+            cur = None
+    return hists
+
+def hist_percentile(buckets: list, q: float) -> float:
+    """Upper bound of the bucket holding quantile q (0 if empty)."""
+    total = sum(b["count"] for b in buckets)
+    if not total:
+        return 0.0
+    seen = 0
+    for b in buckets:
+        seen += b["count"]
+        if seen >= q * total:
+            return float(b["hi"])
+    return float(buckets[-1]["hi"])
 
 class IOMonitor:
-    """Monitor I/O (bpftrace jika tersedia; fallback iostat)."""
-    def __init__(self):
+    """Monitor I/O (bpftrace jika tersedia; fallback iostat).
+
+    With bpftrace the run also gets request-size and issue-to-completion latency
+    histograms per direction and in-flight request count every qd_interval_ms
+    (parse_histograms()). cgroup_path restricts tracing to requests issued from
+    that cgroup (the DB container; kernel writeback is issued elsewhere).
+    """
+    def __init__(self, cgroup_path: str = None, qd_interval_ms: int = 100):
         self.monitoring = False
         self.results = {}
         self.bpftrace_proc = None
         self.duration_seconds = None
+        self.cgroup_path = cgroup_path
+        self.qd_interval_ms = int(qd_interval_ms)
 
     def start_monitoring(self, duration_seconds: int = 30) -> threading.Thread:
         self.duration_seconds = duration_seconds
         def monitor():
-            bpf_script = r'''
-            tracepoint:block:block_rq_issue {
-                @bytes_hist = hist(args->bytes);
-                @total_bytes += args->bytes;
-                @io_count++;
-                if (args->rwbs[0] == "R") { @read_bytes += args->bytes; @read_count++; }
-                else if (args->rwbs[0] == "W") { @write_bytes += args->bytes; @write_count++; }
-            }
-            END {
-                printf("=== FINAL STATS ===\n");
-                printf("Total bytes: %d\n", @total_bytes);
-                printf("Read bytes: %d\n", @read_bytes);
-                printf("Write bytes: %d\n", @write_bytes);
-                printf("Total IOPS: %d\n", @io_count);
-                printf("Read IOPS: %d\n", @read_count);
-                printf("Write IOPS: %d\n", @write_count);
-                print(@bytes_hist);
-            }'''
+            flt = f'/cgroup == cgroupid("{self.cgroup_path}")/ ' if self.cgroup_path else ""
+            bpf_script = BPF_IO_SCRIPT.replace("{FILTER}", flt).replace("{QD_MS}", str(self.qd_interval_ms))
             try:
                 result = subprocess.run(['bpftrace', '--version'], capture_output=True, text=True, timeout=5)
                 if result.returncode != 0:
@@ -180,6 +530,24 @@ class IOMonitor:
     def get_results(self) -> Dict:
         return self.results.copy()
 
+    def parse_histograms(self) -> Dict:
+        """bpftrace size / latency histograms, queue-depth samples and their summary columns ({} without bpftrace)."""
+        out = self.results.get('bpftrace_output') or ''
+        if 'Total bytes:' not in out:
+            return {}
+        raw = parse_bpftrace_hists(out)
+        hists = {key: raw.get(name, []) for name, key in IO_HISTS.items()}
+        qd = [{"t": int(t) / 1000, "qd": max(int(n), 0)}
+              for t, n in re.findall(r"^QD (\d+) (-?\d+)$", out, re.M)]
+        parsed = {"io_hist": hists, "qd_timeline": qd}
+        for d in ("read", "write"):
+            for name, q in (("p50", 0.5), ("p99", 0.99)):
+                parsed[f"dev_{d}_lat_{name}_us"] = hist_percentile(hists[f"{d}_lat_us"], q)
+            parsed[f"dev_{d}_size_p50_kb"] = hist_percentile(hists[f"{d}_size_bytes"], 0.5) / 1024
+        parsed["dev_qd_mean"] = sum(s["qd"] for s in qd) / len(qd) if qd else 0.0
+        parsed["dev_qd_max"] = max((s["qd"] for s in qd), default=0)
+        return parsed
+
     def parse_bandwidth(self) -> Dict[str, float]:
         parsed = {'read_mb': 0.0, 'write_mb': 0.0, 'total_mb': 0.0, 'avg_bandwidth_mb_s': 0.0}
         
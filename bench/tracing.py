@@ -0,0 +1,97 @@
+# /bench/tracing.py
+"""Run timeline as Chrome / Perfetto trace JSON (chrome://tracing, ui.perfetto.dev).
+
+Phases (dataset load, ingest, index build, warm-up, load runs, recall checks)
+are spans, every sample_every-th load-generator request is a span on its
+worker thread's track, and monitor timelines (container stats, cgroup I/O,
+device queue depth, build progress) become counter tracks. Events go to a
+bounded ring buffer (oldest dropped), so recording is one append.
+
+bench.py --trace sets TRACER; the module-level helpers are no-ops otherwise.
+"""
+import itertools, json, math, os, threading, time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+
+TRACER = None
+
+
+class Tracer:
+    def __init__(self, capacity: int = 200_000, sample_every: int = 100):
+        self.events = deque(maxlen=int(capacity))
+        self.sample_every = max(1, int(sample_every))
+        self._requests = itertools.count()
+        self._recorded = itertools.count()
+        self.pid = os.getpid()
+        # one origin for both clocks: requests are timed with perf_counter, monitors with time.time
+        self.w0, self.p0 = time.time(), time.perf_counter()
+
+    def _emit(self, ev: dict):
+        next(self._recorded)
+        self.events.append(ev)
+
+    def _complete(self, name, cat, t_start, t_end, args):
+        self._emit({"name": name, "cat": cat, "ph": "X", "ts": (t_start - self.p0) * 1e6,
+                    "dur": (t_end - t_start) * 1e6, "pid": self.pid, "tid": threading.get_ident(), "args": args})
+
+    @contextmanager
+    def span(self, name: str, cat: str = "phase", **args):
+        """One complete event around the block on the calling thread."""
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._complete(name, cat, t, time.perf_counter(), args)
+
+    def instant(self, name: str, cat: str = "phase", **args):
+        self._emit({"name": name, "cat": cat, "ph": "i", "s": "p", "ts": (time.perf_counter() - self.p0) * 1e6,
+                    "pid": self.pid, "tid": threading.get_ident(), "args": args})
+
+    def request(self, t_start: float, t_end: float, name: str = "search", **args):
+        """One request timed with perf_counter; only every sample_every-th call is kept."""
+        if next(self._requests) % self.sample_every == 0:
+            self._complete(name, "request", t_start, t_end, args)
+
+    def counter(self, name: str, ts: float = None, **values):
+        """Counter sample at wall-clock ts (default now); one track per numeric value key."""
+        ts = time.time() if ts is None else ts
+        values = {k: v for k, v in values.items()
+                  if isinstance(v, (int, float)) and not isinstance(v, bool) and math.isfinite(v)}
+        if values:
+            self._emit({"name": name, "cat": "monitor", "ph": "C", "ts": (ts - self.w0) * 1e6, "pid": self.pid,
+                        "args": values})
+
+    def timeline(self, name: str, samples: list, t0: float, group: str = None):
+        """Merge a monitor timeline (rows with "t" seconds after wall-clock t0) as counters.
+
+        Numeric fields become counter values; rows are split into one track
+        per value of `group` (e.g. "container").
+        """
+        for s in samples or ():
+            self.counter(f"{name} {s[group]}" if group else name, t0 + s["t"],
+                         **{k: v for k, v in s.items() if k != "t"})
+
+    def dump(self, path: str, **meta) -> str:
+        recorded = next(self._recorded)
+        events = sorted(self.events, key=lambda e: e["ts"])
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms",
+                       "otherData": {"start_time": self.w0, "events_recorded": recorded,
+                                     "events_dropped": recorded - len(events),
+                                     "request_sample_every": self.sample_every, **meta}}, f)
+        return path
+
+# ---------------------------------------------------------
+# Module-level helpers (no-ops unless TRACER is set)
+# ---------------------------------------------------------
+def span(name: str, cat: str = "phase", **args):
+    return TRACER.span(name, cat, **args) if TRACER else nullcontext()
+
+def instant(name: str, cat: str = "phase", **args):
+    if TRACER: TRACER.instant(name, cat, **args)
+
+def counter(name: str, ts: float = None, **values):
+    if TRACER: TRACER.counter(name, ts, **values)
+
+def timeline(name: str, samples: list, t0: float, group: str = None):
+    if TRACER: TRACER.timeline(name, samples, t0, group)
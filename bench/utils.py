@@ -1,6 +1,7 @@
 # /bench/utils.py
-import time, math, statistics, numpy as np, subprocess
+import os, time, math, statistics, threading, numpy as np, subprocess
 from typing import List
+from metrics import query_recall
 
 def pct(xs: List[float], p: float) -> float:
     if not xs: return float('nan')
@@ -13,17 +14,184 @@ def percentiles(lat_ms: List[float]) -> dict:
     return {"p50": pct(lat_ms, 0.50), "p95": pct(lat_ms, 0.95), "p99": pct(lat_ms, 0.99),
             "avg": statistics.fmean(lat_ms) if lat_ms else float('nan')}
 
-def brute_force_topk(vectors: np.ndarray, queries: np.ndarray, topk: int, metric="IP") -> np.ndarray:
-    if metric.upper() in ("IP","COSINE"):
-        sims = queries @ vectors.T
-    else:
-        qq = np.sum(queries**2, axis=1, keepdims=True)
-        xx = np.sum(vectors**2, axis=1)
-        sims = -(qq + xx - 2*queries@vectors.T)
-    return np.argpartition(-sims, kth=topk-1, axis=1)[:, :topk]
+class LatencyHistogram:
+    """HDR-style log-bucketed latency histogram with fixed memory.
+
+    Values are recorded in microseconds; each power-of-two range is split into
+    2**(precision_bits-1) linear sub-buckets, so relative error is below
+    2**-(precision_bits-1) (<1.6% at the default 7 bits). Keep one per thread
+    and merge() at the end of a run.
+    """
+    def __init__(self, precision_bits: int = 7, max_value_us: int = 3_600_000_000):
+        self.p = precision_bits
+        self.half = 1 << (precision_bits - 1)
+        self.max_value_us = max_value_us
+        self.counts = np.zeros(self._index(max_value_us) + 1, dtype=np.int64)
+        self.total = 0; self.sum_us = 0; self.min_us = None; self.max_us = 0
+
+    def _index(self, v: int) -> int:
+        b = max(0, v.bit_length() - self.p)
+        return b * self.half + (v >> b)
+
+    def _value(self, idx: int) -> float:
+        """Midpoint (us) of the bucket at idx."""
+        b = max(0, idx // self.half - 1)
+        return ((idx - b * self.half) << b) + ((1 << b) - 1) / 2.0
+
+    def record(self, seconds: float):
+        v = min(max(0, int(seconds * 1e6)), self.max_value_us)
+        self.counts[self._index(v)] += 1
+        self.total += 1; self.sum_us += v
+        self.max_us = max(self.max_us, v)
+        self.min_us = v if self.min_us is None else min(self.min_us, v)
+
+    def merge(self, other: "LatencyHistogram"):
+        self.counts += other.counts
+        self.total += other.total; self.sum_us += other.sum_us
+        self.max_us = max(self.max_us, other.max_us)
+        if other.min_us is not None:
+            self.min_us = other.min_us if self.min_us is None else min(self.min_us, other.min_us)
+        return self
+
+    def __len__(self): return self.total
+
+    def percentile(self, p: float) -> float:
+        """Latency (seconds) at quantile p in [0, 1]."""
+        if not self.total: return float('nan')
+        idx = int(np.searchsorted(np.cumsum(self.counts), max(1, math.ceil(p * self.total))))
+        return min(max(self._value(idx), self.min_us), self.max_us) / 1e6
+
+    def summary(self) -> dict:
+        if not self.total:
+            return {k: None for k in ("min_latency_ms", "mean_latency_ms", "p50_latency_ms", "p95_latency_ms",
+                                      "p99_latency_ms", "p999_latency_ms", "max_latency_ms")}
+        return {"min_latency_ms": self.min_us / 1000, "mean_latency_ms": self.sum_us / self.total / 1000,
+                "p50_latency_ms": self.percentile(0.50) * 1000, "p95_latency_ms": self.percentile(0.95) * 1000,
+                "p99_latency_ms": self.percentile(0.99) * 1000, "p999_latency_ms": self.percentile(0.999) * 1000,
+                "max_latency_ms": self.max_us / 1000, "requests": self.total}
+
+class PhaseTimer:
+    """Wall seconds per named phase of client requests (e.g. serialize / rpc / decode).
+
+    add() writes to a per-thread dict (no lock on the request path);
+    totals() sums every thread since the last reset().
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._local = threading.local()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def add(self, **seconds):
+        d = getattr(self._local, "d", None)
+        if d is None:
+            d = self._local.d = {}
+            with self._lock:
+                self._threads.append(d)
+        for k, v in seconds.items():
+            d[k] = d.get(k, 0.0) + v
+
+    def totals(self) -> dict:
+        out = {}
+        with self._lock:
+            for d in self._threads:
+                for k, v in list(d.items()):
+                    out[k] = out.get(k, 0.0) + v
+        return out
+
+def _normalize(x: np.ndarray) -> np.ndarray:
+    n = np.linalg.norm(x, axis=1, keepdims=True)
+    return x / np.maximum(n, 1e-12)
+
+def pairwise_scores(queries: np.ndarray, x: np.ndarray, metric="IP") -> np.ndarray:
+    """(nq, nx) scores as brute_force_topk ranks them: higher is closer (L2 up to a per-query constant)."""
+    m = metric.upper()
+    q = np.asarray(queries, dtype=np.float32); x = np.asarray(x, dtype=np.float32)
+    if m == "COSINE": q, x = _normalize(q), _normalize(x)
+    s = q @ x.T
+    if m in ("L2", "EUCLID"):
+        s = 2*s - np.sum(x**2, axis=1)[None, :]
+    return s
+
+def _merge_topk(s_a, i_a, s_b, i_b, k):
+    """Keep the k best (highest score) of two candidate sets per row."""
+    s = np.concatenate([s_a, s_b], axis=1); i = np.concatenate([i_a, i_b], axis=1)
+    if s.shape[1] <= k: return s, i
+    p = np.argpartition(-s, kth=k-1, axis=1)[:, :k]
+    return np.take_along_axis(s, p, axis=1), np.take_along_axis(i, p, axis=1)
+
+def brute_force_topk(vectors: np.ndarray, queries: np.ndarray, topk: int, metric="IP",
+                     block_rows: int = 8192, n_threads: int = None, attrs: np.ndarray = None,
+                     filter_lt: int = None) -> np.ndarray:
+    """Exact top-k ids (nq, topk), best first, for metric IP/DOT, COSINE or L2.
+
+    Tiles over block_rows vectors at a time (memmaps are read block by block) and
+    keeps a running top-k per query; tiles run on a thread pool since the matmul
+    releases the GIL. Peak extra memory ~ n_threads * nq * block_rows * 4 bytes.
+    With filter_lt, only rows with attrs < filter_lt are candidates (selected
+    per tile) and rows are padded with -1 to topk when fewer match.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    m = metric.upper()
+    if m not in ("IP", "DOT", "COSINE", "L2", "EUCLID"):
+        raise ValueError(f"Unsupported metric: {metric}")
+    q = np.asarray(queries, dtype=np.float32)
+    if m == "COSINE": q = _normalize(q)
+    nq, N = q.shape[0], vectors.shape[0]
+    k = min(int(topk), N)
+
+    def tile(s):
+        x = np.asarray(vectors[s:s+block_rows], dtype=np.float32)
+        ids = np.arange(s, s + x.shape[0], dtype=np.int64)
+        if filter_lt is not None:
+            keep = np.flatnonzero(np.asarray(attrs[s:s+block_rows]) < filter_lt)
+            x, ids = x[keep], ids[keep]
+        if m == "COSINE": x = _normalize(x)
+        sims = q @ x.T
+        if m in ("L2", "EUCLID"):
+            # -||q-x||^2 up to the per-query constant ||q||^2
+            sims = 2*sims - np.sum(x**2, axis=1)[None, :]
+        if x.shape[0] > k:
+            p = np.argpartition(-sims, kth=k-1, axis=1)[:, :k]
+            return np.take_along_axis(sims, p, axis=1), ids[p]
+        return sims, np.broadcast_to(ids, sims.shape)
+
+    best_s = np.empty((nq, 0), dtype=np.float32); best_i = np.empty((nq, 0), dtype=np.int64)
+    starts = range(0, N, block_rows)
+    n_threads = n_threads or os.cpu_count() or 1
+    # single tile / single thread (e.g. per-request searches): skip the pool
+    ex = ThreadPoolExecutor(max_workers=n_threads) if n_threads > 1 and len(starts) > 1 else None
+    try:
+        for s_b, i_b in (ex.map(tile, starts) if ex else map(tile, starts)):
+            best_s, best_i = _merge_topk(best_s, best_i, s_b, i_b, k)
+    finally:
+        if ex: ex.shutdown()
+    order = np.argsort(-best_s, axis=1, kind="stable")
+    out = np.take_along_axis(best_i, order, axis=1)
+    if filter_lt is not None and out.shape[1] < int(topk):
+        out = np.concatenate([out, np.full((nq, int(topk) - out.shape[1]), -1, dtype=np.int64)], axis=1)
+    return out
 
 def recall_at_k(gt_idx: np.ndarray, res_idx: np.ndarray) -> float:
-    hit = 0
-    for i in range(gt_idx.shape[0]):
-        hit += len(set(gt_idx[i]).intersection(set(res_idx[i])))
-    return hit / (gt_idx.shape[0]*gt_idx.shape[1])
+    """Mean recall@k (k = gt width) over padded result rows; see metrics.py for the full suite."""
+    return float(query_recall(gt_idx, res_idx, gt_idx.shape[1]).mean())
+
+def dir_size_bytes(path: str) -> int:
+    """Allocated bytes under path (du-style, 0 if missing); files may vanish mid-walk."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.lstat(os.path.join(root, f)).st_blocks * 512
+            except FileNotFoundError:
+                pass
+    return total
+
+def ingest_stats(n_vectors: int, dim: int, seconds: float) -> dict:
+    """Ingest throughput for n float32 vectors of size dim loaded in `seconds`."""
+    mb = n_vectors * dim * 4 / (1024*1024)
+    return {"ingest_vectors": int(n_vectors), "ingest_seconds": seconds,
+            "ingest_vectors_per_s": n_vectors / seconds if seconds > 0 else float('nan'),
+            "ingest_mb_per_s": mb / seconds if seconds > 0 else float('nan')}